@@ -1,13 +1,18 @@
 # coding=utf-8
-import torch
+import torch, time
+from collections import defaultdict
 from torch.optim import Optimizer
 
 class AdamWeightDecayOptimizer(Optimizer):
     """A basic Adam optimizer that includes "correct" L2 weight decay.
     https://github.com/google-research/bert/blob/master/optimization.py
-    https://raw.githubusercontent.com/pytorch/pytorch/v1.0.0/torch/optim/adam.py"""
+    https://raw.githubusercontent.com/pytorch/pytorch/v1.0.0/torch/optim/adam.py
+
+    foreach: update all parameters of the same device and dtype with multi-tensor torch._foreach_* ops,
+    same updates as the per-parameter loop; by default used for cuda parameters, where it saves kernel launches
+    (on cpu the loop is faster, it keeps each parameter in cache through all its ops)."""
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False):
+                 weight_decay=0, amsgrad=False, foreach=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -17,13 +22,14 @@ class AdamWeightDecayOptimizer(Optimizer):
         if not 0.0 <= betas[1] < 1.0:
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, amsgrad=amsgrad)
+                        weight_decay=weight_decay, amsgrad=amsgrad, foreach=foreach)
         super(AdamWeightDecayOptimizer, self).__init__(params, defaults)
 
     def __setstate__(self, state):
         super(AdamWeightDecayOptimizer, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsgrad', False)
+            group.setdefault('foreach', None)
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -37,6 +43,12 @@ class AdamWeightDecayOptimizer(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            foreach = group['foreach']
+            if foreach is None:
+                foreach = hasattr(torch, '_foreach_addcmul_') and all(p.is_cuda for p in group['params'])
+            if foreach:
+                self._foreach_step(group)
+                continue
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -85,4 +97,75 @@ class AdamWeightDecayOptimizer(Optimizer):
                 # of the weights to the loss with plain (non-momentum) SGD.
                 update = (exp_avg/denom).add_(group['weight_decay'], p.data)
                 p.data.add_(-group['lr'], update)
-        return loss
\ No newline at end of file
+        return loss
+    def _foreach_step(self, group):
+        amsgrad = group['amsgrad']
+        beta1, beta2 = group['betas']
+        tensors = defaultdict(lambda: defaultdict(list))
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
+            state = self.state[p]
+            if len(state) == 0:
+                state['step'] = 0
+                state['exp_avg'] = torch.zeros_like(p.data)
+                state['exp_avg_sq'] = torch.zeros_like(p.data)
+                if amsgrad:
+                    state['max_exp_avg_sq'] = torch.zeros_like(p.data)
+            state['step'] += 1
+            bucket = tensors[(p.device, p.dtype)]
+            bucket['params'].append(p.data)
+            bucket['grads'].append(p.grad.data)
+            bucket['exp_avgs'].append(state['exp_avg'])
+            bucket['exp_avg_sqs'].append(state['exp_avg_sq'])
+            if amsgrad:
+                bucket['max_exp_avg_sqs'].append(state['max_exp_avg_sq'])
+
+        for bucket in tensors.values():
+            params, grads = bucket['params'], bucket['grads']
+            exp_avgs, exp_avg_sqs = bucket['exp_avgs'], bucket['exp_avg_sqs']
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+            if amsgrad:
+                for max_exp_avg_sq, exp_avg_sq in zip(bucket['max_exp_avg_sqs'], exp_avg_sqs):
+                    torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+                denom = torch._foreach_sqrt(bucket['max_exp_avg_sqs'])
+            else:
+                denom = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_add_(denom, group['eps'])
+            # decoupled weight decay, see step
+            update = torch._foreach_div(exp_avgs, denom)
+            torch._foreach_add_(update, params, alpha=group['weight_decay'])
+            torch._foreach_add_(params, update, alpha=-group['lr'])
+
+
+if __name__ == "__main__":
+    # micro-benchmark: the per-parameter loop against the multi-tensor step on parameters shaped like the parser's
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    shapes = [(512, 512), (512,), (1024, 512), (512, 1024), (1024,), (1536, 512), (1536,), (300, 512), (100, 512)] * 24
+    results = []
+    for foreach in (False, True):
+        torch.manual_seed(0)
+        params = [torch.nn.Parameter(torch.randn(shape, device=device)) for shape in shapes]
+        optimizer = AdamWeightDecayOptimizer([{'params': params[::2], 'weight_decay': 1e-4},
+                                              {'params': params[1::2], 'weight_decay': 0.}],
+                                             1e-3, betas=(0.9, 0.999), eps=1e-6, foreach=foreach)
+        grads = [torch.randn(shape, device=device) for shape in shapes]
+        for step in range(55):
+            if step == 5:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+            for p, g in zip(params, grads):
+                p.grad = g * (step + 1)
+            optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        print('foreach=%s: %.2f ms/step' % (foreach, (time.time() - start) / 50 * 1000))
+        results.append(params)
+    print('max difference', max((p - q).abs().max().item() for p, q in zip(*results)))
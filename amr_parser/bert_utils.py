@@ -1,37 +1,68 @@
-import torch
+import torch, os, threading, hashlib
+from collections import OrderedDict
 from transformers import BertTokenizer, ElectraModel as BertModel
 import numpy as np
 
+from amr_parser.data import ArraysToTensor, BertFeatures
+
 
 class BertEncoderTokenizer(BertTokenizer):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, wordpiece_cache_size=1 << 16, **kwargs):
         super(BertEncoderTokenizer, self).__init__(*args, **kwargs)
+        # surface form -> wordpiece ids, least recently used first; the server tokenizes from many threads
+        self._wordpiece_cache = OrderedDict()
+        self._wordpiece_cache_size = wordpiece_cache_size
+        self._wordpiece_cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_wordpiece_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._wordpiece_cache_lock = threading.Lock()
+
+    def wordpiece_ids(self, token):
+        with self._wordpiece_cache_lock:
+            ids = self._wordpiece_cache.get(token, None)
+            if ids is not None:
+                self._wordpiece_cache.move_to_end(token)
+                return ids
+        ids = self.convert_tokens_to_ids(self.wordpiece_tokenizer.tokenize(token))
+        with self._wordpiece_cache_lock:
+            self._wordpiece_cache[token] = ids
+            if len(self._wordpiece_cache) > self._wordpiece_cache_size:
+                self._wordpiece_cache.popitem(last=False)
+        return ids
+
+    def batch_tokenize(self, batch):
+        """
+        :param batch: list of token lists
+        :return: token_ids [batch_size, num_subwords] and gather_indexes [batch_size, 1 + num_tokens, max_subwords],
+            the subword positions of [CLS] and each token, both padded with 0
+        """
+        pieces = [[self.wordpiece_ids(token) for token in ['[CLS]'] + tokens + ['[SEP]']] for tokens in batch]
+        lens = [np.array([len(x) for x in y], dtype=np.int64) for y in pieces]
+        token_ids = np.zeros((len(batch), max(x.sum() for x in lens)), dtype=np.int64)
+        # We only want CLS and tokens (exclude SEP)
+        max_index_list_len = max(x[:-1].max() for x in lens)
+        gather_indexes = np.zeros((len(batch), max(len(x) for x in lens) - 1, max_index_list_len), dtype=np.int64)
+        offsets = np.arange(max_index_list_len)
+        for i, (y, x) in enumerate(zip(pieces, lens)):
+            token_ids[i, :x.sum()] = [sub_token for token in y for sub_token in token]
+            starts = np.cumsum(x) - x
+            gather_indexes[i, :len(x) - 1] = np.where(offsets < x[:-1, None], starts[:-1, None] + offsets, 0)
+        return token_ids, gather_indexes
 
     def tokenize(self, tokens, split=True):
-        tokens = ['[CLS]'] + tokens + ['[SEP]']
         if not split:
+            tokens = ['[CLS]'] + tokens + ['[SEP]']
             split_tokens = [t if t in self.vocab else '[UNK]' for t in tokens]
-            gather_indexes = None
-        else:
-            split_tokens, _gather_indexes = [], []
-            for token in tokens:
-                indexes = []
-                for i, sub_token in enumerate(self.wordpiece_tokenizer.tokenize(token)):
-                    indexes.append(len(split_tokens))
-                    split_tokens.append(sub_token)
-                _gather_indexes.append(indexes)
-
-            # We only want CLS and tokens (exclude SEP)
-            _gather_indexes = _gather_indexes[:-1]
-            max_index_list_len = max(len(indexes) for indexes in _gather_indexes)
-            gather_indexes = np.zeros((len(_gather_indexes), max_index_list_len))
-            for i, indexes in enumerate(_gather_indexes):
-                for j, index in enumerate(indexes):
-                    gather_indexes[i, j] = index
-
-        token_ids = np.array(self.convert_tokens_to_ids(split_tokens))
-        return token_ids, gather_indexes
+            return np.array(self.convert_tokens_to_ids(split_tokens)), None
+        token_ids, gather_indexes = self.batch_tokenize([tokens])
+        return token_ids[0], gather_indexes[0]
 
     def _back_to_txt_for_check(self, token_ids):
         for tokens in token_ids:
@@ -63,25 +94,24 @@ class BertEncoder(BertModel):
 
     def average_pooling(self, encoded_layers, token_subword_index):
         batch_size, num_tokens, num_subwords = token_subword_index.size()
-        batch_index = torch.arange(batch_size).view(-1, 1, 1).type_as(token_subword_index)
-        token_index = torch.arange(num_tokens).view(1, -1, 1).type_as(token_subword_index)
         _, num_total_subwords, hidden_size = encoded_layers.size()
-        expanded_encoded_layers = encoded_layers.unsqueeze(1).expand(
-            batch_size, num_tokens, num_total_subwords, hidden_size)
-        # [batch_size, num_tokens, num_subwords, hidden_size]
-        token_reprs = expanded_encoded_layers[batch_index, token_index, token_subword_index]
-        subword_pad_mask = token_subword_index.eq(0).unsqueeze(3).expand(
-            batch_size, num_tokens, num_subwords, hidden_size)
-        token_reprs.masked_fill_(subword_pad_mask, 0)
-        # [batch_size, num_tokens, hidden_size]
-        sum_token_reprs = torch.sum(token_reprs, dim=2)
+        # index 0 is padding
+        subword_mask = token_subword_index.ne(0)
+        # a flat subword -> token map over the valid subwords only
+        batch_offset = torch.arange(batch_size, device=token_subword_index.device).view(-1, 1, 1)
+        subword = (token_subword_index + batch_offset * num_total_subwords)[subword_mask]
+        token = torch.arange(batch_size * num_tokens, device=token_subword_index.device).view(
+            batch_size, num_tokens, 1).expand_as(token_subword_index)[subword_mask]
+        # [batch_size * num_tokens, hidden_size]
+        sum_token_reprs = encoded_layers.new_zeros(batch_size * num_tokens, hidden_size).index_add_(
+            0, token, encoded_layers.reshape(-1, hidden_size).index_select(0, subword))
         # [batch_size, num_tokens]
-        num_valid_subwords = token_subword_index.ne(0).sum(dim=2)
+        num_valid_subwords = subword_mask.sum(dim=2)
         pad_mask = num_valid_subwords.eq(0).long()
         # Add ones to arrays where there is no valid subword.
         divisor = (num_valid_subwords + pad_mask).unsqueeze(2).type_as(sum_token_reprs)
         # [batch_size, num_tokens, hidden_size]
-        avg_token_reprs = sum_token_reprs / divisor
+        avg_token_reprs = sum_token_reprs.view(batch_size, num_tokens, hidden_size) / divisor
         return avg_token_reprs
 
     def max_pooling(self, encoded_layers, token_subword_index):
@@ -104,3 +134,81 @@ class BertEncoder(BertModel):
             batch_size, num_tokens, hidden_size)
         max_token_reprs.masked_fill(pad_mask, 0)
         return max_token_reprs
+
+
+def encoder_id(bert_encoder):
+    """identifies bert_encoder by its name, its config and a fixed sample of the values of each of its weights"""
+    h = hashlib.sha1(bert_encoder.config.name_or_path.encode('utf-8'))
+    h.update(bert_encoder.config.to_json_string().encode('utf-8'))
+    for name, weight in bert_encoder.state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(weight.detach().reshape(-1)[::997].float().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def load_bert_features(bert_encoder, data, path, batch_size=32):
+    """
+    The features of the frozen bert_encoder for data (a DataLoader) stored in path; they are computed, in batches
+    of batch_size sentences of similar length, when path is missing or was made for other data or another encoder.
+    """
+    encoder = encoder_id(bert_encoder)
+    if os.path.exists(path) and os.path.exists(path + '.index.npz'):
+        features = BertFeatures(path)
+        if features.fingerprint == BertFeatures.fingerprint_of(data, encoder):
+            return features
+        print("%s is outdated" % path)
+    print("compute bert features into %s" % path)
+    features = BertFeatures.create(path, data, encoder, bert_encoder.config.hidden_size)
+    device = next(bert_encoder.parameters()).device
+    # features without dropout, the encoder is frozen anyway
+    training = bert_encoder.training
+    bert_encoder.eval()
+    idx = sorted(range(len(data.data)), key=lambda x: data.bert_len[x])
+    with torch.no_grad():
+        for start in range(0, len(idx), batch_size):
+            batch = [data.data[i] for i in idx[start:start + batch_size]]
+            bert_token = torch.from_numpy(ArraysToTensor([x['bert_token'] for x in batch])).to(device)
+            token_subword_index = torch.from_numpy(ArraysToTensor([x['token_subword_index'] for x in batch]))
+            bert_embed = bert_encoder(bert_token, token_subword_index=token_subword_index.to(device))
+            bert_embed = bert_embed.half().cpu().numpy()
+            for j, i in enumerate(idx[start:start + batch_size]):
+                features.write(i, bert_embed[j, :1 + data.tok_len[i]])
+    features.features.flush()
+    bert_encoder.train(training)
+    return BertFeatures(path)
+
+
+if __name__ == "__main__":
+    # check: average_pooling against the original gather over a (batch, token, subword, hidden) expansion, on
+    # random subword indexes with padding, tokens without subwords and sentences without tokens
+    def gather_average_pooling(encoded_layers, token_subword_index):
+        batch_size, num_tokens, num_subwords = token_subword_index.size()
+        batch_index = torch.arange(batch_size).view(-1, 1, 1).type_as(token_subword_index)
+        token_index = torch.arange(num_tokens).view(1, -1, 1).type_as(token_subword_index)
+        _, num_total_subwords, hidden_size = encoded_layers.size()
+        expanded_encoded_layers = encoded_layers.unsqueeze(1).expand(
+            batch_size, num_tokens, num_total_subwords, hidden_size)
+        token_reprs = expanded_encoded_layers[batch_index, token_index, token_subword_index]
+        subword_pad_mask = token_subword_index.eq(0).unsqueeze(3).expand(
+            batch_size, num_tokens, num_subwords, hidden_size)
+        token_reprs.masked_fill_(subword_pad_mask, 0)
+        sum_token_reprs = torch.sum(token_reprs, dim=2)
+        num_valid_subwords = token_subword_index.ne(0).sum(dim=2)
+        pad_mask = num_valid_subwords.eq(0).long()
+        divisor = (num_valid_subwords + pad_mask).unsqueeze(2).type_as(sum_token_reprs)
+        return sum_token_reprs / divisor
+
+    torch.manual_seed(0)
+    batch_size, num_tokens, num_subwords, num_total_subwords, hidden_size = 8, 12, 4, 40, 16
+    for trial in range(20):
+        lens = torch.randint(0, num_subwords + 1, (batch_size, num_tokens))
+        lens[0] = 0  # a sentence without tokens
+        lens[1, num_tokens // 2:] = 0  # a padded one
+        starts = (lens.cumsum(-1) - lens + 1).clamp(max=num_total_subwords - num_subwords)
+        offsets = torch.arange(num_subwords)
+        token_subword_index = torch.where(offsets < lens.unsqueeze(-1), starts.unsqueeze(-1) + offsets, 0)
+        encoded_layers = torch.randn(batch_size, num_total_subwords, hidden_size)
+        reference = gather_average_pooling(encoded_layers, token_subword_index)
+        result = BertEncoder.average_pooling(None, encoded_layers, token_subword_index)
+        assert torch.allclose(result, reference, atol=1e-6), (result - reference).abs().max()
+    print('average_pooling matches the gather implementation')
@@ -1,4 +1,5 @@
-import random
+import random, os, mmap, pickle, hashlib, tempfile
+from functools import lru_cache
 import numpy as np
 from amr_parser.extract import read_file
 
@@ -111,18 +112,43 @@ def ArraysToTensor(xs):
     return data
 
 
-def batchify(data, vocabs, unk_rate=0.):
-    _tok = ListsToTensor([[CLS] + x['tok'] for x in data], vocabs['tok'], unk_rate=unk_rate)
-    _lem = ListsToTensor([[CLS] + x['lem'] for x in data], vocabs['lem'], unk_rate=unk_rate)
-    _upos = ListsToTensor([[CLS] + x['upos'] for x in data], vocabs['upos'], unk_rate=unk_rate)
-    _ner = ListsToTensor([[CLS] + x['ner'] for x in data], vocabs['ner'], unk_rate=unk_rate)
-    _tok_char = ListsofStringToTensor([[CLS] + x['tok'] for x in data], vocabs['tok_char'])
+@lru_cache(maxsize=1 << 18)
+def string_ids(vocab, x, max_string_len=20):
+    """the char ids of one token, one row of ListsofStringToTensor"""
+    z = list(x[:max_string_len])
+    return tuple(vocab.token2idx([CLS] + z + [END]) + [vocab.padding_idx] * (max_string_len - len(z)))
+
+
+def strings_ids(xs, vocab, max_string_len=20):
+    return np.array([string_ids(vocab, x, max_string_len) for x in xs], dtype=np.int64).reshape(
+        len(xs), max_string_len + 2)
+
+
+def pad_ids(xs, pad, unk_idx=None, unk_rate=0.):
+    """
+    xs: list of int arrays of shape len_i (x dim), the padded seq_len x bsz (x dim) array, like ListsToTensor
+    unk_rate: each position that is not padding becomes unk_idx with this probability
+    """
+    lens = np.array([len(x) for x in xs])
+    max_len = lens.max()
+    data = np.full((max_len, len(xs)) + xs[0].shape[1:], pad, dtype=np.int64)
+    for i, x in enumerate(xs):
+        data[:len(x), i] = x
+    if unk_rate > 0.:
+        # one draw from the python rng keeps batches reproducible under random.seed
+        rng = np.random.RandomState(random.getrandbits(32))
+        mask = (np.arange(max_len)[:, None] < lens) & (rng.random_sample(data.shape) < unk_rate)
+        data[mask] = unk_idx
+    return data
 
-    local_token2idx = [x['token2idx'] for x in data]
-    local_idx2token = [x['idx2token'] for x in data]
-    _cp_seq = ListsToTensor([x['cp_seq'] for x in data], vocabs['predictable_concept'], local_token2idx)
-    _mp_seq = ListsToTensor([x['mp_seq'] for x in data], vocabs['predictable_concept'], local_token2idx)
 
+def lookup(xs, vocab, local_vocab=None):
+    if local_vocab is None:
+        return np.array(vocab.token2idx(xs), dtype=np.int64)
+    return np.array([local_vocab[x] if x in local_vocab else vocab.token2idx(x) for x in xs], dtype=np.int64)
+
+
+def batchify_graph(data, vocabs, local_token2idx, unk_rate=0.):
     concept, edge = [], []
     for x in data:
         amr = x['amr']
@@ -132,38 +158,68 @@ def batchify(data, vocabs, unk_rate=0.):
 
     augmented_concept = [[DUM] + x + [END] for x in concept]
 
-    _concept_in = ListsToTensor(augmented_concept, vocabs['concept'], unk_rate=unk_rate)[:-1]
-    _concept_char_in = ListsofStringToTensor(augmented_concept, vocabs['concept_char'])[:-1]
-    _concept_out = ListsToTensor(augmented_concept, vocabs['predictable_concept'], local_token2idx)[1:]
+    concept_vocab = vocabs['concept']
+    _concept_in = pad_ids([lookup(x, concept_vocab) for x in augmented_concept],
+                          concept_vocab.padding_idx, concept_vocab.unk_idx, unk_rate)[:-1]
+    _concept_char_in = pad_ids([strings_ids(x, vocabs['concept_char']) for x in augmented_concept],
+                               strings_ids([PAD], vocabs['concept_char'])[0])[:-1]
+    _concept_out = pad_ids([lookup(x, vocabs['predictable_concept'], local_vocab)
+                            for x, local_vocab in zip(augmented_concept, local_token2idx)],
+                           vocabs['predictable_concept'].padding_idx)[1:]
 
     out_conc_len, bsz = _concept_out.shape
     _rel = np.full((1 + out_conc_len, bsz, out_conc_len), vocabs['rel'].token2idx(PAD))
     # v: [<dummy>, concept_0, ..., concept_l, ..., concept_{n-1}, <end>] u: [<dummy>, concept_0, ..., concept_l, ..., concept_{n-1}]
 
-    for bidx, (x, y) in enumerate(zip(edge, concept)):
-        for l, _ in enumerate(y):
-            if l > 0:
-                # l=1 => pos=l+1=2
-                _rel[l + 1, bidx, 1:l + 1] = vocabs['rel'].token2idx(NIL)
-        for v, u, r in x:
-            r = vocabs['rel'].token2idx(r)
-            _rel[v + 1, bidx, u + 1] = r
+    # concept_l (l > 0) has no relation to the concepts before it unless there is an edge: pos=l+1, u in [1, l]
+    nil_v, nil_b, nil_u = [], [], []
+    for bidx, y in enumerate(concept):
+        v, u = np.tril_indices(len(y), -1)
+        nil_v.append(v + 1)
+        nil_u.append(u + 1)
+        nil_b.append(np.full(len(v), bidx))
+    _rel[np.concatenate(nil_v), np.concatenate(nil_b), np.concatenate(nil_u)] = vocabs['rel'].token2idx(NIL)
+
+    edge_b = [bidx for bidx, x in enumerate(edge) for _ in x]
+    if edge_b:
+        v, u, r = zip(*[e for x in edge for e in x])
+        _rel[np.array(v) + 1, edge_b, np.array(u) + 1] = vocabs['rel'].token2idx(list(r))
+
+    return {
+        'rel': _rel,
+        'concept_in': _concept_in,
+        'concept_char_in': _concept_char_in,
+        'concept_out': _concept_out,
+    }
+
+
+def batchify(data, vocabs, unk_rate=0.):
+    _tok = pad_ids([x['tok_idx'] for x in data], vocabs['tok'].padding_idx, vocabs['tok'].unk_idx, unk_rate)
+    _lem = pad_ids([x['lem_idx'] for x in data], vocabs['lem'].padding_idx, vocabs['lem'].unk_idx, unk_rate)
+    _upos = pad_ids([x['upos_idx'] for x in data], vocabs['upos'].padding_idx, vocabs['upos'].unk_idx, unk_rate)
+    _ner = pad_ids([x['ner_idx'] for x in data], vocabs['ner'].padding_idx, vocabs['ner'].unk_idx, unk_rate)
+    _tok_char = pad_ids([x['tok_char_idx'] for x in data], strings_ids([PAD], vocabs['tok_char'])[0])
+
+    local_token2idx = [x['token2idx'] for x in data]
+    local_idx2token = [x['idx2token'] for x in data]
+    _cp_seq = pad_ids([x['cp_idx'] for x in data], vocabs['predictable_concept'].padding_idx)
+    _mp_seq = pad_ids([x['mp_idx'] for x in data], vocabs['predictable_concept'].padding_idx)
 
     ret = {
         'tok': _tok,
         'lem': _lem,
         'upos': _upos,
         'ner': _ner,
-        'rel': _rel,
         'tok_char': _tok_char,
-        'concept_in': _concept_in,
-        'concept_char_in': _concept_char_in,
-        'concept_out': _concept_out,
         'copy_seq': np.stack([_cp_seq, _mp_seq], -1),
         'local_token2idx': local_token2idx,
         'local_idx2token': local_idx2token,
     }
 
+    # sentences to be parsed (e.g. served online) come without graphs
+    if all(x['amr'] is not None for x in data):
+        ret.update(batchify_graph(data, vocabs, local_token2idx, unk_rate))
+
     bert_tokenizer = vocabs.get('bert_tokenizer', None)
     if bert_tokenizer is not None:
         ret['bert_token'] = ArraysToTensor([x['bert_token'] for x in data])
@@ -171,60 +227,282 @@ def batchify(data, vocabs, unk_rate=0.):
     return ret
 
 
-class DataLoader(object):
-    def __init__(self, vocabs, lex_map, filename, batch_size, for_train):
-        self.data = []
-        bert_tokenizer = vocabs.get('bert_tokenizer', None)
+def make_datum(vocabs, lex_map, token, lemma, upos, xpos, ner, amr=None):
+    cp_seq, mp_seq, token2idx, idx2token = lex_map.get_concepts(lemma, token, vocabs['predictable_concept'])
+    datum = {
+        'amr': amr,
+        'tok': token,
+        'lem': lemma,
+        'upos': upos,
+        'xpos': xpos,
+        'ner': ner,
+        'cp_seq': cp_seq,
+        'mp_seq': mp_seq,
+        'token2idx': token2idx,
+        'idx2token': idx2token,
+        # indexed once here, batchify only pads
+        'tok_idx': lookup([CLS] + token, vocabs['tok']),
+        'lem_idx': lookup([CLS] + lemma, vocabs['lem']),
+        'upos_idx': lookup([CLS] + upos, vocabs['upos']),
+        'ner_idx': lookup([CLS] + ner, vocabs['ner']),
+        'tok_char_idx': strings_ids([CLS] + token, vocabs['tok_char']),
+        'cp_idx': lookup(cp_seq, vocabs['predictable_concept'], token2idx),
+        'mp_idx': lookup(mp_seq, vocabs['predictable_concept'], token2idx),
+    }
+    bert_tokenizer = vocabs.get('bert_tokenizer', None)
+    if bert_tokenizer is not None:
+        bert_token, token_subword_index = bert_tokenizer.tokenize(token)
+        datum['bert_token'] = bert_token
+        datum['token_subword_index'] = token_subword_index
+    return datum
+
+
+CORPUS_CACHE_VERSION = 2
+
+
+def corpus_fingerprint(vocabs, filename):
+    """identifies what make_datum produces for filename: the file itself, the vocabularies and the bert tokenizer"""
+    stat = os.stat(filename)
+    h = hashlib.sha1(('%d %s %d %d' % (CORPUS_CACHE_VERSION, os.path.abspath(filename), stat.st_size,
+                                       stat.st_mtime_ns)).encode('utf-8'))
+    for name in sorted(vocabs):
+        vocab = vocabs[name]
+        if isinstance(vocab, Vocab):
+            tokens = vocab._idx2token
+        else:
+            # the bert tokenizer
+            tokens = [type(vocab).__name__] + sorted(vocab.vocab, key=vocab.vocab.get)
+        h.update(name.encode('utf-8'))
+        h.update('\n'.join(tokens).encode('utf-8'))
+    return h.hexdigest()
+
+
+def compile_corpus(vocabs, lex_map, filename, cache_file):
+    """
+    Reads filename once and writes every datum to cache_file, so later runs can skip the penman parsing,
+    the lexical mapping and the bert tokenization.
+    layout: [pickled datum] * n, [pickled index], 8 bytes little-endian offset of the index
+    """
+    offsets, tok_len, amr_len, bert_len, trainable = [0], [], [], [], []
+    # a temporary file of its own, so separate jobs compiling the same corpus never write into each other
+    fd, tmp_file = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(cache_file) + '.',
+                                    dir=os.path.dirname(os.path.abspath(cache_file)))
+    with os.fdopen(fd, 'wb') as fo:
         for token, lemma, upos, xpos, ner, amr in zip(*read_file(filename)):
+            datum = make_datum(vocabs, lex_map, token, lemma, upos, xpos, ner, amr)
+            fo.write(pickle.dumps(datum, protocol=pickle.HIGHEST_PROTOCOL))
+            # root_centered_sort shuffles the graph, so only after it is written
+            _, _, not_ok = amr.root_centered_sort()
+            offsets.append(fo.tell())
+            tok_len.append(len(token))
+            amr_len.append(len(amr))
+            bert_len.append(len(datum.get('bert_token', ())))
+            trainable.append(not not_ok and len(token) > 0)
+        index = {
+            'fingerprint': corpus_fingerprint(vocabs, filename),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'tok_len': np.array(tok_len, dtype=np.int64),
+            'amr_len': np.array(amr_len, dtype=np.int64),
+            'bert_len': np.array(bert_len, dtype=np.int64),
+            'trainable': np.array(trainable, dtype=np.bool_),
+        }
+        fo.write(pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL))
+        fo.write(offsets[-1].to_bytes(8, 'little'))
+    os.replace(tmp_file, cache_file)
+
+
+class CompiledCorpus(object):
+    """The data of a compile_corpus file, memory-mapped; a datum is only unpickled when it is asked for."""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._open()
+        index_start = int.from_bytes(self._mm[-8:], 'little')
+        self.index = pickle.loads(self._mm[index_start:-8])
+        self.ids = np.arange(len(self.index['tok_len']))
+
+    def _open(self):
+        with open(self.cache_file, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def select(self, mask):
+        self.ids = np.flatnonzero(mask)
+
+    def field(self, name):
+        return self.index[name][self.ids].tolist()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        j = self.ids[i]
+        return pickle.loads(self._mm[self.index['offsets'][j]:self.index['offsets'][j + 1]])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_mm']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+
+def load_corpus(vocabs, lex_map, filename, cache_file):
+    """the compiled corpus in cache_file, (re)compiled first if it is missing or was made from other inputs"""
+    fingerprint = corpus_fingerprint(vocabs, filename)
+    if os.path.exists(cache_file):
+        corpus = CompiledCorpus(cache_file)
+        if corpus.index['fingerprint'] == fingerprint:
+            return corpus
+        print("%s is outdated" % cache_file)
+    print("compile %s into %s" % (filename, cache_file))
+    compile_corpus(vocabs, lex_map, filename, cache_file)
+    return CompiledCorpus(cache_file)
+
+
+class BertFeatures(object):
+    """
+    fp16 outputs of the bert encoder ([CLS] and every token) for each datum of a DataLoader, in a memory-mapped
+    path (rows of all data back to back, a .npy file) and path.index.npz (offsets and fingerprint).
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        index = np.load(path + '.index.npz')
+        self.offsets = index['offsets']
+        self.fingerprint = str(index['fingerprint'])
+        self.features = np.load(path, mmap_mode=mode)
+
+    @staticmethod
+    def fingerprint_of(data, encoder_id):
+        """identifies the encoder inputs of data (subword ids and their tokens) and the encoder (see encoder_id
+        of bert_utils)"""
+        h = hashlib.sha1(encoder_id.encode('utf-8'))
+        h.update(np.array(data.tok_len, dtype=np.int64).tobytes())
+        for i in range(len(data.data)):
+            datum = data.data[i]
+            h.update(np.asarray(datum['bert_token'], dtype=np.int64).tobytes())
+            h.update(np.asarray(datum['token_subword_index'], dtype=np.int64).tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def create(cls, path, data, encoder_id, hidden_size):
+        """empty features for data (a DataLoader), to be filled with write"""
+        offsets = np.cumsum([0] + [1 + x for x in data.tok_len]).astype(np.int64)
+        np.savez(path + '.index.npz', offsets=offsets, fingerprint=cls.fingerprint_of(data, encoder_id))
+        np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=(int(offsets[-1]), hidden_size))
+        return cls(path, mode='r+')
+
+    def write(self, i, x):
+        self.features[self.offsets[i]:self.offsets[i + 1]] = x
+
+    def batch(self, idx):
+        """bsz x seq_len x hidden, zeros at padding like BertEncoder.average_pooling"""
+        lens = [self.offsets[i + 1] - self.offsets[i] for i in idx]
+        data = np.zeros((len(idx), max(lens), self.features.shape[1]), dtype=np.float16)
+        for j, i in enumerate(idx):
+            data[j, :lens[j]] = self.features[self.offsets[i]:self.offsets[i + 1]]
+        return data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['features']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.features = np.load(self.path, mmap_mode=self.mode)
+
+
+class DataLoader(object):
+    def __init__(self, vocabs, lex_map, filename, batch_size, for_train, sort_by_length=False, cache=False):
+        """
+        batch_size: number of tokens per batch, or with sort_by_length, the padded size of the source side
+            (bsz x max bert subwords, or bsz x max tokens without bert) that a batch may not exceed
+        sort_by_length: for inference, batch sentences of similar length together; every batch carries the
+            original positions of its sentences in 'index'
+        cache: load the data from filename + '.cache', which is compiled on first use (see compile_corpus)
+        """
+        if cache:
+            self.data = load_corpus(vocabs, lex_map, filename, filename + '.cache')
+            keep = self.data.index['bert_len'] <= 512
             if for_train:
-                _, _, not_ok = amr.root_centered_sort()
-                if not_ok or len(token) == 0:
-                    continue
-            cp_seq, mp_seq, token2idx, idx2token = lex_map.get_concepts(lemma, token, vocabs['predictable_concept'])
-            datum = {
-                'amr': amr,
-                'tok': token,
-                'lem': lemma,
-                'upos': upos,
-                'xpos': xpos,
-                'ner': ner,
-                'cp_seq': cp_seq,
-                'mp_seq': mp_seq,
-                'token2idx': token2idx,
-                'idx2token': idx2token
-            }
-            if bert_tokenizer is not None:
-                bert_token, token_subword_index = bert_tokenizer.tokenize(token)
+                keep &= self.data.index['trainable']
+            self.data.select(keep)
+            self.tok_len = self.data.field('tok_len')
+            self.amr_len = self.data.field('amr_len')
+            self.bert_len = self.data.field('bert_len')
+        else:
+            self.data = []
+            for token, lemma, upos, xpos, ner, amr in zip(*read_file(filename)):
+                if for_train:
+                    _, _, not_ok = amr.root_centered_sort()
+                    if not_ok or len(token) == 0:
+                        continue
+                datum = make_datum(vocabs, lex_map, token, lemma, upos, xpos, ner, amr)
                 # todo
-                if len(bert_token) > 512:
+                if len(datum.get('bert_token', ())) > 512:
                     continue
-                datum['bert_token'] = bert_token
-                datum['token_subword_index'] = token_subword_index
 
-            self.data.append(datum)
+                self.data.append(datum)
+            self.tok_len = [len(x['tok']) for x in self.data]
+            self.amr_len = [len(x['amr']) for x in self.data]
+            self.bert_len = [len(x.get('bert_token', ())) for x in self.data]
         print("Get %d AMRs from %s" % (len(self.data), filename))
         self.vocabs = vocabs
         self.batch_size = batch_size
         self.train = for_train
+        self.sort_by_length = sort_by_length
         self.unk_rate = 0.
+        self.bert_features = None
 
     def set_unk_rate(self, x):
         self.unk_rate = x
 
-    def __iter__(self):
+    def set_bert_features(self, features):
+        """batches carry the precomputed 'bert_embed' of features (a BertFeatures for this DataLoader)"""
+        self.bert_features = features
+
+    def source_len(self, i):
+        # positions the encoders see for the i-th datum, bert subwords dominate when present
+        if self.bert_len[i] > 0:
+            return self.bert_len[i]
+        return 1 + self.tok_len[i]
+
+    def length_buckets(self):
+        idx = sorted(range(len(self.data)), key=self.source_len)
+        batches = []
+        data, max_len = [], 0
+        for i in idx:
+            max_len = max(max_len, self.source_len(i))
+            if data and (len(data) + 1) * max_len > self.batch_size:
+                batches.append(data)
+                data, max_len = [], self.source_len(i)
+            data.append(i)
+        if data:
+            batches.append(data)
+        return batches
+
+    def batch_plan(self, rng=random):
+        """the batches, as lists of positions in data, of one pass over the data; shuffled with rng for training"""
+        if self.sort_by_length and not self.train:
+            return self.length_buckets()
+
         idx = list(range(len(self.data)))
 
         if self.train:
-            random.shuffle(idx)
-            idx.sort(key=lambda x: len(self.data[x]['tok']) + len(self.data[x]['amr']))
+            rng.shuffle(idx)
+            idx.sort(key=lambda x: self.tok_len[x] + self.amr_len[x])
 
         batches = []
         num_tokens, data = 0, []
         for i in idx:
-            num_tokens += len(self.data[i]['tok']) + len(self.data[i]['amr'])
-            data.append(self.data[i])
+            num_tokens += self.tok_len[i] + self.amr_len[i]
+            data.append(i)
             if num_tokens >= self.batch_size:
-                sz = len(data) * (2 + max(len(x['tok']) for x in data) + max(len(x['amr']) for x in data))
+                sz = len(data) * (2 + max(self.tok_len[x] for x in data) + max(self.amr_len[x] for x in data))
                 if sz > GPU_SIZE:
                     # because we only have limited GPU memory
                     batches.append(data[:len(data) // 2])
@@ -232,7 +510,7 @@ class DataLoader(object):
                 batches.append(data)
                 num_tokens, data = 0, []
         if data:
-            sz = len(data) * (2 + max(len(x['tok']) for x in data) + max(len(x['amr']) for x in data))
+            sz = len(data) * (2 + max(self.tok_len[x] for x in data) + max(self.amr_len[x] for x in data))
             if sz > GPU_SIZE:
                 # because we only have limited GPU memory
                 batches.append(data[:len(data) // 2])
@@ -240,7 +518,17 @@ class DataLoader(object):
             batches.append(data)
 
         if self.train:
-            random.shuffle(batches)
+            rng.shuffle(batches)
+        return batches
 
-        for batch in batches:
-            yield batchify(batch, self.vocabs, self.unk_rate)
+    def make_batch(self, idx):
+        batch = batchify([self.data[i] for i in idx], self.vocabs, self.unk_rate)
+        if self.bert_features is not None:
+            batch['bert_embed'] = self.bert_features.batch(idx)
+        if self.sort_by_length and not self.train:
+            batch['index'] = idx
+        return batch
+
+    def __iter__(self):
+        for idx in self.batch_plan():
+            yield self.make_batch(idx)
@@ -19,11 +19,11 @@ class ArcGenerator(nn.Module):
         self.ff_layer_norm = nn.LayerNorm(embed_dim)
         self.dropout = dropout
 
-    def forward(self, outs, graph_state, graph_padding_mask, attn_mask, target_rel=None, work=False):
+    def forward(self, outs, graph_state, graph_padding_mask, attn_mask, target_rel=None, work=False, graph_kv=None):
         x, arc_weight = self.arc_layer(outs, graph_state, graph_state,
                                        key_padding_mask=graph_padding_mask,
                                        attn_mask=attn_mask,
-                                       need_weights='max')
+                                       need_weights='max', static_kv=graph_kv)
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = self.arc_layer_norm(outs + x)
         residual = x
@@ -69,10 +69,15 @@ class ConceptGenerator(nn.Module):
         nn.init.constant_(self.generator.bias, 0.)
 
     def forward(self, outs, snt_state, snt_padding_mask, copy_seq,
-                target=None, work=False):
+                target=None, work=False, topk=None, snt_kv=None):
+        """
+        with work and topk, returns (ll, token) of the candidates that contain the topk concepts instead
+        of the log-likelihoods of the whole (extended) vocabulary, see candidates
+        snt_kv: keys and values of snt_state for the alignment, already projected
+        """
         x, alignment_weight = self.alignment_layer(outs, snt_state, snt_state,
                                                     key_padding_mask=snt_padding_mask,
-                                                    need_weights='one')
+                                                    need_weights='one', static_kv=snt_kv)
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = self.alignment_layer_norm(outs + x)
         residual = x
@@ -86,13 +91,19 @@ class ConceptGenerator(nn.Module):
         outs_concept = torch.tanh(self.transfer(outs))
         outs_concept = F.dropout(outs_concept, p=self.dropout, training=self.training)
 
-        gen_gate, map_gate, copy_gate = F.softmax(self.diverter(outs_concept), -1).chunk(3, dim=-1)
+        # gates, probabilities and the copy scatter_add stay in fp32 under reduced precision autocast
+        gen_gate, map_gate, copy_gate = F.softmax(self.diverter(outs_concept).float(), -1).chunk(3, dim=-1)
         copy_gate = torch.cat([copy_gate, map_gate], -1)
-        
-        probs = gen_gate * F.softmax(self.generator(outs_concept), -1)
+        logits = self.generator(outs_concept).float()
+        if work and topk is not None:
+            return self.candidates(logits, gen_gate, copy_gate, alignment_weight, copy_seq, topk), outs
+
+        probs = gen_gate * F.softmax(logits, -1)
 
-        tot_ext = 1 + copy_seq.max().item()
+        # local (copied) concepts are numbered from vocab_size on, at most two for each source token,
+        # sizing by shape avoids a device sync and keeps the step traceable
         vocab_size = probs.size(-1)
+        tot_ext = vocab_size + copy_seq.size(0) * copy_seq.size(2)
 
         if tot_ext - vocab_size > 0:
             ext_probs = probs.new_zeros((1, 1, tot_ext - vocab_size)).expand(seq_len, bsz, -1)
@@ -121,6 +132,40 @@ class ConceptGenerator(nn.Module):
         concept_loss = concept_loss.masked_fill_(concept_mask, 0.).sum(0)
         return concept_loss, outs
 
+    def candidates(self, logits, gen_gate, copy_gate, alignment_weight, copy_seq, topk):
+        """
+        the topk generated concepts and all the copied ones, with the same log-likelihoods as the dense
+        distribution of forward; any other concept is less likely than the topk generated ones, so they
+        contain the topk concepts. The dense softmax, extension and scatter_add are never built.
+        returns ll, token: tgt_len x bsz x (topk + src_len x 2), candidates given more than once have ll -inf
+        """
+        seq_len, bsz, vocab_size = logits.size()
+        gen_logits, gen_token = logits.topk(topk, -1)
+
+        # copies of the same concept are grouped by sorting, the first of each run stands for the concept
+        copy_token = copy_seq.transpose(0, 1).contiguous().view(1, bsz, -1).expand(seq_len, -1, -1)
+        copy_probs = (copy_gate.unsqueeze(2) * alignment_weight.unsqueeze(-1)).view(seq_len, bsz, -1)
+        copy_token, order = copy_token.sort(dim=-1, stable=True)
+        first = torch.cat([torch.ones_like(copy_token[..., :1], dtype=torch.bool),
+                           copy_token[..., 1:].ne(copy_token[..., :-1])], -1)
+        run = first.long().cumsum(-1) - 1
+        copy_mass = torch.zeros_like(copy_probs).scatter_add_(-1, run, copy_probs.gather(-1, order)).gather(-1, run)
+        copy_logits = logits.gather(-1, copy_token.clamp(max=vocab_size - 1))
+        copy_logits = copy_logits.masked_fill(copy_token.ge(vocab_size), float('-inf'))
+
+        # generated candidates that are copied as well take the copy probabilities of their run
+        same = gen_token.unsqueeze(-1).eq(copy_token.unsqueeze(-2)) & first.unsqueeze(-2)
+        gen_mass = torch.matmul(same.type_as(copy_mass), copy_mass.unsqueeze(-1)).squeeze(-1)
+
+        # log-sum-exp in place, logits are not needed anymore
+        log_norm = gen_logits[..., :1] + logits.sub_(gen_logits[..., :1]).exp_().sum(-1, keepdim=True).log()
+        probs = gen_gate * torch.exp(torch.cat([gen_logits, copy_logits], -1) - log_norm) \
+                + torch.cat([gen_mass, copy_mass], -1)
+        ll = torch.log(probs + 1e-12)
+        repeated = first.logical_not() | same.any(-2)
+        ll = ll.masked_fill(torch.cat([torch.zeros_like(gen_token, dtype=torch.bool), repeated], -1), float('-inf'))
+        return ll, torch.cat([gen_token, copy_token], -1)
+
 class RelationGenerator(nn.Module):
 
     def __init__(self, vocabs, embed_dim, rel_size, dropout):
@@ -174,7 +219,7 @@ class RelationGenerator(nn.Module):
 
         dep_num, bsz, _ = outs.size()
         head_num = graph_state.size(0)
-        log_probs = F.log_softmax(scores, dim=-1)
+        log_probs = F.log_softmax(scores.float(), dim=-1)
         _, rel = torch.max(log_probs, -1)
         if work:
             #dep_num x bsz x head x vocab
@@ -203,16 +248,21 @@ class DecodeLayer(nn.Module):
     def forward(self, probe, snt_state, graph_state,
                 snt_padding_mask, graph_padding_mask, attn_mask,
                 copy_seq, target=None, target_rel=None,
-                work=False):
+                work=False, graph_kv=None, topk=None, snt_kv=None):
         # probe: tgt_len x bsz x embed_dim
         # snt_state, graph_state: seq_len x bsz x embed_dim
+        # graph_kv: keys and values of graph_state for the arc attention, already projected (incremental decoding)
+        # topk: concept candidates (ll, token) instead of the dense concept_ll, see ConceptGenerator.candidates
+        # snt_kv: keys and values of snt_state for the concept alignment, already projected
 
         outs = F.dropout(probe, p=self.dropout, training=self.training)
 
         if work:
             for i in range(self.inference_layers):
-                arc_ll, outs = self.arc_generator(outs, graph_state, graph_padding_mask, attn_mask, work=True)
-                concept_ll, outs = self.concept_generator(outs, snt_state, snt_padding_mask, copy_seq, work=True)
+                arc_ll, outs = self.arc_generator(outs, graph_state, graph_padding_mask, attn_mask, work=True,
+                                                  graph_kv=graph_kv)
+                concept_ll, outs = self.concept_generator(outs, snt_state, snt_padding_mask, copy_seq, work=True,
+                                                          topk=topk, snt_kv=snt_kv)
             rel_ll = self.relation_generator(outs, graph_state, work=True)
             return concept_ll, arc_ll, rel_ll
 
@@ -227,3 +277,37 @@ class DecodeLayer(nn.Module):
         arc_loss = arc_losses[-1] #torch.stack(arc_losses).mean(0)
         concept_loss = concept_losses[-1] #torch.stack(concept_losses).mean(0)
         return concept_loss, arc_loss, rel_loss
+
+
+if __name__ == "__main__":
+    # check: the topk of ConceptGenerator.candidates against the topk of the dense distribution, with repeated
+    # copies, copies of generated concepts, local concepts beyond the vocab and padded sources
+    from types import SimpleNamespace
+    torch.manual_seed(0)
+    vocab_size, src_len, bsz, embed_dim, topk = 60, 9, 16, 32, 8
+    generator = ConceptGenerator({'predictable_concept': SimpleNamespace(size=vocab_size)}, embed_dim, 64, 24, 0.)
+    nn.init.normal_(generator.generator.weight, std=1.)
+    generator.eval()
+    for trial in range(20):
+        outs = torch.randn(1, bsz, embed_dim)
+        snt_state = torch.randn(src_len, bsz, embed_dim)
+        lengths = torch.randint(1, src_len + 1, (bsz,))
+        snt_padding_mask = torch.arange(src_len).unsqueeze(1).ge(lengths.unsqueeze(0))
+        # few distinct ids, so that copies repeat and hit the generated ones, some beyond the vocab
+        copy_seq = torch.randint(0, 12, (src_len, bsz, 2)) * 6
+        copy_seq[..., 1] = torch.where(torch.rand(src_len, bsz).lt(0.5), vocab_size + copy_seq[..., 1] // 6,
+                                       copy_seq[..., 1])
+        copy_seq = copy_seq.masked_fill(snt_padding_mask.unsqueeze(-1), 0)
+        with torch.no_grad():
+            ll, _ = generator(outs, snt_state, snt_padding_mask, copy_seq, work=True)
+            (cand_ll, cand_token), _ = generator(outs, snt_state, snt_padding_mask, copy_seq, work=True, topk=topk)
+        scores, token = ll.topk(topk, -1)
+        cand_scores, pos = cand_ll.topk(topk, -1)
+        assert torch.equal(token, cand_token.gather(-1, pos)), trial
+        assert torch.allclose(scores, cand_scores, atol=1e-5), (scores - cand_scores).abs().max()
+        # every concept is a candidate at most once
+        finite = cand_ll.isfinite()
+        for row in range(bsz):
+            ids = cand_token[0, row][finite[0, row]].tolist()
+            assert len(ids) == len(set(ids)), ids
+    print('candidates match the dense topk')
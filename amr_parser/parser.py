@@ -5,12 +5,104 @@ import math
 
 from amr_parser.encoder import ConceptEncoder, WordEncoder
 from amr_parser.decoder import DecodeLayer
-from amr_parser.transformer import Transformer, SinusoidalPositionalEmbedding, SelfAttentionMask
+from amr_parser.transformer import Transformer, SinusoidalPositionalEmbedding, SelfAttentionMask, DecoderCache
 from amr_parser.data import ListsToTensor, ListsofStringToTensor, DUM, NIL, PAD
 from amr_parser.search import Hypothesis, Beam, search_by_batch
 from amr_parser.utils import move_to_device
 
 
+class DecodeStep(nn.Module):
+    """The numeric part of one incremental decoding step of a Parser, with tensor inputs and outputs only.
+
+    Vocab lookups, hypotheses and the DecoderCache bookkeeping stay in Parser.decode_step, so this module
+    can be traced or exported (e.g. torch.jit.trace, torch.export) and run without the Python overhead.
+    The modules are shared with the parser, not copied. topk is the number of generated concept candidates,
+    None gives the whole extended vocabulary (e.g. for averaging the distributions of several parsers).
+    """
+
+    def __init__(self, parser, topk):
+        super(DecodeStep, self).__init__()
+        self.topk = topk
+        self.concept_encoder = parser.concept_encoder
+        self.concept_embed_layer_norm = parser.concept_embed_layer_norm
+        self.graph_layers = parser.graph_encoder.layers
+        self.decoder = parser.decoder
+        self.embed_positions = parser.embed_positions
+        self.embed_scale = parser.embed_scale
+
+    @staticmethod
+    def cache_names(graph_layers):
+        """the names of the states in cache, in order"""
+        names = []
+        for idx in range(graph_layers):
+            names += ['concept_repr_%d_k' % idx, 'concept_repr_%d_v' % idx]
+        return names + ['graph_state', 'arc_k', 'arc_v']
+
+    @staticmethod
+    def memory_names(graph_layers):
+        """the names of the projected sentence memory, in order, see Parser.project_memory"""
+        names = []
+        for idx in range(graph_layers):
+            names += ['snt_k_%d' % idx, 'snt_v_%d' % idx]
+        return names + ['alignment_k', 'alignment_v']
+
+    def forward(self, concept, concept_char, snt_padding_mask, probe, copy_seq, cache, memory):
+        """
+        concept: 1 x bsz, concept_char: 1 x bsz x char_len, ids of the newest concepts
+        snt_padding_mask: src_len x bsz, probe: 1 x bsz x embed_dim, copy_seq: src_len x bsz x 2
+        cache: list of the states named by cache_names, each step + 1 x bsz x embed_dim, positions [0, step)
+               are read and position step is written in place
+        memory: list of the keys and values named by memory_names, each src_len x bsz x embed_dim
+        returns the log-likelihoods and ids of the concept candidates (1 x bsz x topk + src_len x 2, see
+        ConceptGenerator.candidates, or the extended vocabulary when topk is None) and the log-likelihoods of
+        arcs (1 x bsz x step + 1) and relations (1 x bsz x step + 1 x rel_vocab)
+        """
+        step = cache[0].size(0) - 1
+        concept_repr = self.embed_scale * self.concept_encoder(concept_char, concept) \
+                       + self.embed_positions(concept, step)
+        concept_repr = self.concept_embed_layer_norm(concept_repr)
+        for idx, layer in enumerate(self.graph_layers):
+            k, v = cache[2 * idx], cache[2 * idx + 1]
+            new_k, new_v = layer.self_attn.in_proj_kv(concept_repr)
+            k[step:].copy_(new_k)
+            v[step:].copy_(new_v)
+            concept_repr, _, _ = layer(concept_repr, self_kv=(k, v), external_padding_mask=snt_padding_mask,
+                                       external_kv=(memory[2 * idx], memory[2 * idx + 1]))
+        graph_state, arc_k, arc_v = cache[-3:]
+        graph_state[step:].copy_(concept_repr)
+        new_k, new_v = self.decoder.arc_generator.arc_layer.in_proj_kv(concept_repr)
+        arc_k[step:].copy_(new_k)
+        arc_v[step:].copy_(new_v)
+        concept_ll, arc_ll, rel_ll = self.decoder(probe, None, graph_state, snt_padding_mask, None, None, copy_seq,
+                                                  work=True, graph_kv=(arc_k, arc_v), topk=self.topk,
+                                                  snt_kv=tuple(memory[-2:]))
+        if self.topk is None:
+            concept_token = torch.arange(concept_ll.size(-1), device=concept_ll.device).expand_as(concept_ll)
+        else:
+            concept_ll, concept_token = concept_ll
+        return concept_ll, concept_token, arc_ll, rel_ll
+
+
+def score_step(concept_ll, concept_token, arc_ll, rel_ll, topk):
+    """
+    the records and the topk (scores, tokens) of one decoding step (see search_by_batch) from the outputs
+    of DecodeStep, a concept is scored together with the confidence of its arc decisions
+    """
+    # only the best relation of each (dep, head) pair is needed by the final graphs
+    records = {'arc_ll': arc_ll, 'rel': rel_ll.argmax(-1)}
+    pred_arc_prob = torch.exp(arc_ll)
+    arc_confidence = torch.log(torch.max(pred_arc_prob, 1 - pred_arc_prob))
+    arc_confidence[:, :, 0] = 0.
+    # pred_arc = torch.lt(pred_arc_prob, 0.5)
+    # pred_arc[:,:,0] = 1
+    # rel_confidence = rel_ll.masked_fill(pred_arc, 0.).sum(-1, keepdim=True)
+    LL = concept_ll + arc_confidence.sum(-1, keepdim=True)  # + rel_confidence
+
+    topk_scores, topk_pos = torch.topk(LL.squeeze(0), topk, 1)  # bsz x k
+    topk_token = concept_token.squeeze(0).gather(1, topk_pos)
+    return records, topk_scores, topk_token
+
+
 class Parser(nn.Module):
     def __init__(self, vocabs,
                  word_char_dim, word_dim, char2word_dim, pos_dim, ner_dim,
@@ -54,10 +146,12 @@ class Parser(nn.Module):
         nn.init.normal_(self.probe_generator.weight, std=0.02)
         nn.init.constant_(self.probe_generator.bias, 0.)
 
-    def encode_step_with_bert(self, tok, lem, pos, ner, word_char, bert_token, token_subword_index):
+    def encode_step_with_bert(self, tok, lem, pos, ner, word_char, bert_token, token_subword_index, bert_embed=None):
+        """bert_embed: precomputed outputs of the (frozen) bert_encoder, bsz x seq_len x hidden, see BertFeatures"""
         word_repr = self.word_encoder(word_char, tok, lem, pos, ner)
-        bert_embed = self.bert_encoder(bert_token, token_subword_index=token_subword_index)
-        bert_embed = bert_embed.transpose(0, 1)
+        if bert_embed is None:
+            bert_embed = self.bert_encoder(bert_token, token_subword_index=token_subword_index)
+        bert_embed = bert_embed.transpose(0, 1).type_as(word_repr)
         word_repr = word_repr + self.bert_adaptor(bert_embed)
         word_repr = self.embed_scale * word_repr + self.embed_positions(tok)
 
@@ -69,102 +163,85 @@ class Parser(nn.Module):
 
         return word_repr[1:], word_mask[1:], probe
 
-    def work(self, data, beam_size, max_time_step, min_time_step=1):
-        with torch.no_grad():
-            word_repr, word_mask, probe = self.encode_step_with_bert(
-                data['tok'], data['lem'], data['upos'], data['ner'],
-                data['tok_char'], data['bert_token'], data['token_subword_index']
-            )
-
-            mem_dict = {'snt_state': word_repr,
-                        'snt_padding_mask': word_mask,
-                        'probe': probe,
-                        'local_idx2token': data['local_idx2token'],
+    def work(self, data, beam_size, max_time_step, min_time_step=1, dtype=None, alpha=None, prune_margin=None):
+        """
+        dtype: run encoding and decoding under autocast to this dtype (e.g. torch.bfloat16), the concept
+               probabilities, copy scatter_add, arc probabilities and all log-likelihoods stay in fp32
+        alpha, prune_margin: early exit of hopeless beams and hypotheses, see search_by_batch
+        """
+        device_type = self.probe_generator.weight.device.type
+        with torch.no_grad(), torch.autocast(device_type, dtype=dtype, enabled=dtype is not None):
+            mem_dict = {'local_idx2token': data['local_idx2token'],
                         'copy_seq': data['copy_seq']}
-            init_state_dict = {}
+            mem_dict.update(self.encode_memory(data, data.get('bert_embed', None)))
+            bsz = len(data['local_idx2token'])
+            init_state_dict = {'cache': DecoderCache(max_time_step, bsz * beam_size)}
             init_hyp = Hypothesis(init_state_dict, [DUM], 0.)
-            bsz = word_repr.size(1)
             beams = [Beam(beam_size, min_time_step, max_time_step, [init_hyp]) for i in range(bsz)]
-            search_by_batch(self, beams, mem_dict)
+            search_by_batch(self, beams, mem_dict, alpha, prune_margin)
         return beams
 
+    def encode_memory(self, data, bert_embed=None):
+        """the parts of mem_dict (see search_by_batch) that come from this parser's encoding of the sentences"""
+        word_repr, word_mask, probe = self.encode_step_with_bert(
+            data['tok'], data['lem'], data['upos'], data['ner'],
+            data['tok_char'], data['bert_token'], data['token_subword_index'], bert_embed
+        )
+        # the sentence memory is only attended to, its keys and values are projected once here
+        mem_dict = {'snt_padding_mask': word_mask,
+                    'probe': probe}
+        mem_dict.update(zip(DecodeStep.memory_names(len(self.graph_encoder.layers)),
+                            self.project_memory(word_repr)))
+        return mem_dict
+
+    def project_memory(self, snt_state):
+        """the keys and values of snt_state for the external attention of every graph layer and for the
+        concept alignment, in the order of DecodeStep.memory_names"""
+        memory = []
+        for layer in self.graph_encoder.layers:
+            memory += layer.external_attn.in_proj_kv(snt_state)
+        memory += self.decoder.concept_generator.alignment_layer.in_proj_kv(snt_state)
+        return memory
+
     def prepare_incremental_input(self, step_seq):
         conc = ListsToTensor(step_seq, self.vocabs['concept'])
         conc_char = ListsofStringToTensor(step_seq, self.vocabs['concept_char'])
         conc, conc_char = move_to_device(conc, self.device), move_to_device(conc_char, self.device)
         return conc, conc_char
 
-    def decode_step(self, inp, state_dict, mem_dict, offset, topk):
+    def get_decode_step(self, topk):
+        """the DecodeStep run by decode_step, it is kept outside the module tree so the state dict is unchanged"""
+        steps = self.__dict__.setdefault('_decode_steps', dict())
+        if steps.get(topk, None) is None:
+            steps[topk] = DecodeStep(self, topk)
+        return steps[topk]
+
+    def set_decode_step(self, module, topk):
+        """run decode_step with module, e.g. a traced or exported DecodeStep(self, topk)"""
+        self.__dict__.setdefault('_decode_steps', dict())[topk] = module
+
+    def run_decode_step(self, inp, cache, mem_dict, offset, topk):
+        """the outputs of get_decode_step(topk) for one step, the newest position of cache is filled"""
         step_concept, step_concept_char = inp
-        word_repr = snt_state = mem_dict['snt_state']
-        word_mask = snt_padding_mask = mem_dict['snt_padding_mask']
         probe = mem_dict['probe']
-        copy_seq = mem_dict['copy_seq']
-        local_vocabs = mem_dict['local_idx2token']
-        _, bsz, _ = word_repr.size()
+        _, bsz, _ = probe.size()
+        graph_layers = len(self.graph_encoder.layers)
 
-        new_state_dict = {}
+        cache_states = cache.views(DecodeStep.cache_names(graph_layers), offset, bsz, probe)
+        memory = [mem_dict[name] for name in DecodeStep.memory_names(graph_layers)]
+        return self.get_decode_step(topk)(step_concept, step_concept_char, mem_dict['snt_padding_mask'], probe,
+                                          mem_dict['copy_seq'], cache_states, memory)
 
-        concept_repr = self.embed_scale * self.concept_encoder(step_concept_char, step_concept) \
-                       + self.embed_positions(step_concept, offset)
-        concept_repr = self.concept_embed_layer_norm(concept_repr)
-        for idx, layer in enumerate(self.graph_encoder.layers):
-            name_i = 'concept_repr_%d' % idx
-            if name_i in state_dict:
-                prev_concept_repr = state_dict[name_i]
-                new_concept_repr = torch.cat([prev_concept_repr, concept_repr], 0)
-            else:
-                new_concept_repr = concept_repr
-
-            new_state_dict[name_i] = new_concept_repr
-            concept_repr, _, _ = layer(concept_repr, kv=new_concept_repr, external_memories=word_repr,
-                                       external_padding_mask=word_mask)
-        name = 'graph_state'
-        if name in state_dict:
-            prev_graph_state = state_dict[name]
-            new_graph_state = torch.cat([prev_graph_state, concept_repr], 0)
-        else:
-            new_graph_state = concept_repr
-        new_state_dict[name] = new_graph_state
-        conc_ll, arc_ll, rel_ll = self.decoder(probe, snt_state, new_graph_state, snt_padding_mask, None, None,
-                                               copy_seq, work=True)
-        for i in range(offset):
-            name = 'arc_ll%d' % i
-            new_state_dict[name] = state_dict[name]
-            name = 'rel_ll%d' % i
-            new_state_dict[name] = state_dict[name]
-        name = 'arc_ll%d' % offset
-        new_state_dict[name] = arc_ll
-        name = 'rel_ll%d' % offset
-        new_state_dict[name] = rel_ll
-        pred_arc_prob = torch.exp(arc_ll)
-        arc_confidence = torch.log(torch.max(pred_arc_prob, 1 - pred_arc_prob))
-        arc_confidence[:, :, 0] = 0.
-        # pred_arc = torch.lt(pred_arc_prob, 0.5)
-        # pred_arc[:,:,0] = 1
-        # rel_confidence = rel_ll.masked_fill(pred_arc, 0.).sum(-1, keepdim=True)
-        LL = conc_ll + arc_confidence.sum(-1, keepdim=True)  # + rel_confidence
-
-        def idx2token(idx, local_vocab):
-            if idx in local_vocab:
-                return local_vocab[idx]
-            return self.vocabs['predictable_concept'].idx2token(idx)
-
-        topk_scores, topk_token = torch.topk(LL.squeeze(0), topk, 1)  # bsz x k
-
-        results = []
-        for s, t, local_vocab in zip(topk_scores.tolist(), topk_token.tolist(), local_vocabs):
-            res = []
-            for score, token in zip(s, t):
-                res.append((idx2token(token, local_vocab), score))
-            results.append(res)
-
-        return new_state_dict, results
+    def decode_step(self, inp, state_dict, mem_dict, offset, topk):
+        new_state_dict = {'cache': state_dict['cache']}
+        records, topk_scores, topk_token = score_step(*self.run_decode_step(inp, state_dict['cache'], mem_dict,
+                                                                            offset, topk), topk)
+        return new_state_dict, records, topk_scores, topk_token
 
     def forward(self, data):
         word_repr, word_mask, probe = self.encode_step_with_bert(
             data['tok'], data['lem'], data['upos'], data['ner'],
-            data['tok_char'], data['bert_token'], data['token_subword_index']
+            data['tok_char'], data['bert_token'], data['token_subword_index'], data.get('bert_embed', None)
         )
         concept_repr = self.embed_scale * self.concept_encoder(data['concept_char_in'], data['concept_in']) + \
                        self.embed_positions(data['concept_in'])
@@ -200,3 +277,55 @@ class Parser(nn.Module):
         graph_arc_loss = graph_arc_loss / concept_tot
 
         return concept_loss.mean(), arc_loss.mean(), rel_loss.mean(), graph_arc_loss.mean()
+
+
+class EnsembleParser(nn.Module):
+    """Parsers (e.g. checkpoints of one training run) that decode together, one beam search for all of them.
+
+    The parsers must share the vocabs and the bert_encoder, which is run once per batch. Each parser encodes
+    the sentences and keeps its own decoder cache, the concept, arc and relation log-likelihoods of every
+    step are averaged over the parsers before the candidates are scored.
+    """
+
+    def __init__(self, parsers):
+        super(EnsembleParser, self).__init__()
+        self.parsers = nn.ModuleList(parsers)
+        self.vocabs = parsers[0].vocabs
+        self.device = parsers[0].device
+        self.bert_encoder = parsers[0].bert_encoder
+
+    def work(self, data, beam_size, max_time_step, min_time_step=1, dtype=None, alpha=None, prune_margin=None):
+        """see Parser.work"""
+        device_type = self.parsers[0].probe_generator.weight.device.type
+        with torch.no_grad(), torch.autocast(device_type, dtype=dtype, enabled=dtype is not None):
+            bert_embed = data.get('bert_embed', None)
+            if bert_embed is None:
+                bert_embed = self.bert_encoder(data['bert_token'], token_subword_index=data['token_subword_index'])
+            mem_dict = {'local_idx2token': data['local_idx2token'],
+                        'copy_seq': data['copy_seq']}
+            for idx, parser in enumerate(self.parsers):
+                for k, v in parser.encode_memory(data, bert_embed).items():
+                    mem_dict['%d/%s' % (idx, k)] = v
+            bsz = len(data['local_idx2token'])
+            init_state_dict = {'cache_%d' % idx: DecoderCache(max_time_step, bsz * beam_size)
+                               for idx in range(len(self.parsers))}
+            init_hyp = Hypothesis(init_state_dict, [DUM], 0.)
+            beams = [Beam(beam_size, min_time_step, max_time_step, [init_hyp]) for i in range(bsz)]
+            search_by_batch(self, beams, mem_dict, alpha, prune_margin)
+        return beams
+
+    def prepare_incremental_input(self, step_seq):
+        return self.parsers[0].prepare_incremental_input(step_seq)
+
+    def decode_step(self, inp, state_dict, mem_dict, offset, topk):
+        outputs = []
+        for idx, parser in enumerate(self.parsers):
+            prefix = '%d/' % idx
+            parser_mem_dict = {k[len(prefix):]: v for k, v in mem_dict.items() if k.startswith(prefix)}
+            parser_mem_dict['copy_seq'] = mem_dict['copy_seq']
+            # the candidates of the parsers differ, their distributions are averaged over the whole vocabulary
+            outputs.append(parser.run_decode_step(inp, state_dict['cache_%d' % idx], parser_mem_dict, offset, None))
+        concept_ll, concept_token, arc_ll, rel_ll = outputs[0]
+        concept_ll, arc_ll, rel_ll = [torch.stack(x).mean(0) for x in zip(*[(c, a, r) for c, _, a, r in outputs])]
+        records, topk_scores, topk_token = score_step(concept_ll, concept_token, arc_ll, rel_ll, topk)
+        return dict(state_dict), records, topk_scores, topk_token
@@ -10,10 +10,7 @@ class PostProcessor(object):
         self.amr = penman
         self.rel_vocab = rel_vocab
 
-    def to_triple(self, res_concept, res_relation):
-        """ res_concept: list of strings
-            res_relation: list of (dep:int, head:int, arc_prob:float, rel_prob:list(vocab))
-        """
+    def _instances(self, res_concept):
         ret = []
         names = []
         for i, c in enumerate(res_concept):
@@ -27,6 +24,13 @@ class PostProcessor(object):
                     name = c
                 name = name + '@attr%d@' % i
             names.append(name)
+        return ret, names
+
+    def to_triple(self, res_concept, res_relation):
+        """ res_concept: list of strings
+            res_relation: list of (dep:int, head:int, arc_prob:float, rel_prob:list(vocab))
+        """
+        ret, names = self._instances(res_concept)
 
         grouped_relation = dict()
         for i, j, p, r in res_relation:
@@ -58,9 +62,56 @@ class PostProcessor(object):
                     ret.append((names[max_j], max_r, names[i]))
         return ret
 
-    def get_string(self, x):
-        return self.amr.encode(penman.Graph(x), top=x[0][0])
+    def to_triple_dense(self, res_concept, arc_prob, rel):
+        """ res_concept: list of strings
+            arc_prob: float array (dep x head), arc probabilities of heads before each dependent
+            rel: int array (dep x head), ids of the best relations
+            same decisions as to_triple, made on whole arrays
+        """
+        ret, names = self._instances(res_concept)
+        num_concepts = len(res_concept)
+        is_attr = np.array([_is_attr_form(c) for c in res_concept], dtype=bool)
+        # heads must come before the dependent and can not be attributes
+        valid = np.tril(np.ones((num_concepts, num_concepts), dtype=bool), -1) & ~is_attr[None, :]
+        arc_prob = np.where(valid, arc_prob, -1.)
 
-    def postprocess(self, concept, relation):
-        mstr = self.get_string(self.to_triple(concept, relation))
+        # every confident arc into a non-attribute, then the most probable arc when there is no confident one
+        # (or the dependent is an attribute); within a dependent, arcs go by head then the fallback one
+        dep, head = np.nonzero((arc_prob >= 0.5) & ~is_attr[:, None])
+        max_head = arc_prob.argmax(-1)
+        fallback = (arc_prob.max(-1) < 0.5) | is_attr
+        fallback[0] = False
+        fallback_dep = np.nonzero(fallback)[0]
+        dep = np.concatenate([dep, fallback_dep])
+        head = np.concatenate([head, max_head[fallback_dep]])
+        order = np.lexsort((np.arange(dep.shape[0]), dep))
+
+        for i, j in zip(dep[order].tolist(), head[order].tolist()):
+            r = self.rel_vocab.idx2token(int(rel[i, j]))
+            if r.endswith('_reverse_'):
+                ret.append((names[i], r[:-9], names[j]))
+            else:
+                ret.append((names[j], r, names[i]))
+        return ret
+
+    def get_string(self, x, indent=-1):
+        return self.amr.encode(penman.Graph(x), top=x[0][0], indent=indent)
+
+    def triples(self, concept, relation):
+        """ relation: list of (dep, head, arc_prob, rel_prob) for to_triple,
+            or (arc_prob, rel) arrays for to_triple_dense
+        """
+        if isinstance(relation, tuple):
+            return self.to_triple_dense(concept, *relation)
+        return self.to_triple(concept, relation)
+
+    def to_string(self, triples, indent=-1):
+        """ indent: None puts the graph on one line
+        """
+        mstr = self.get_string(triples, indent)
         return re.sub(r'@attr\d+@', '', mstr)
+
+    def postprocess(self, concept, relation):
+        """ relation: see triples
+        """
+        return self.to_string(self.triples(concept, relation))
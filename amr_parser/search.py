@@ -1,13 +1,18 @@
 import torch
+from functools import lru_cache
 from amr_parser.data import END, UNK
 from amr_parser.AMRGraph import _is_attr_form
 
 """
  Beam search by batch
  need model has two functions:
-    (1) decode_step
+    (1) decode_step, returns (state_dict, records, topk_scores, topk_token)
     (2) prepare_incremental_input
- when adapted to other use, modify those parts that are labeled by ##rewrite## accordingly. 
+ all alive hypotheses of all sentences are kept in one flat batch dimension (sentence-major order),
+ candidate scoring and top-k selection are done with tensor ops, and the decoder states are
+ reordered with one index_select per step. the memory (mem_dict) is expanded to the flat batch only when
+ the number of alive hypotheses of some sentence changes.
+ when adapted to other use, modify those parts that are labeled by ##rewrite## accordingly.
 """
 
 
@@ -15,16 +20,24 @@ from amr_parser.AMRGraph import _is_attr_form
 ##rewrite##
 ###########
 class Hypothesis(object):
-    def __init__(self, state_dict, seq, score):
+    def __init__(self, state_dict, seq, score, history=None):
         '''
         state_dict: hidden states of the last step (has not yet consider seq[-1])
-            for each item in state_dict, it must have shape of (seq_len x bsz x *) or (bsz x dim)
+            for each item in state_dict, it must have shape of (seq_len x bsz x *) or (bsz x dim),
+            or be an object shared by the whole batch that has index_select(index) (e.g. DecoderCache)
         seq: current generated sequence
         score: accumlated score so far (include seq[-1])
+        history: (History, step, row), where the per-step records of this hypothesis end
         '''
         self.state_dict = state_dict
         self.seq = seq
         self.score = score
+        self.history = history
+
+    def trace(self, name):
+        """the records of name produced along this hypothesis, one for each step"""
+        history, step, row = self.history
+        return history.trace(name, step, row)
 
     def is_completed(self):
         ###########
@@ -49,70 +62,6 @@ class Beam(object):
         self.steps = 0
         self.hypotheses = hypotheses  # hypotheses are the collection of *alive* hypotheses only
 
-    def merge_score(self, prev_hyp, step):
-        # step has two attributes: token and score
-        ###########
-        ##rewrite##
-        ###########
-        token, score = step
-        prefix = prev_hyp.seq
-
-        if len(prefix) == 1 and _is_attr_form(token):
-            return float('-inf')
-        if not token.endswith('_') and (':' in token or '/' in token or ',' in token):
-            return float('-inf')
-        if token == UNK:
-            return float('-inf')
-        new_score = prev_hyp.score + score
-        return new_score
-
-    def update(self, new_states, next_steps):
-        '''
-        each hypothesis in the beam have consumed its seq[-1], producing new states and #beam_size possible next steps
-        new_states: for each item in new_states, it must have the shape of (seq_len x #num_hypotheses x *) or (#num_hypotheses x dim)
-        next_steps: list (#num_hypotheses) of list (#beam_size) of (token, score)
-        '''
-        # collect the top (#beam_size-len(self.completed_hypotheses)) new candidates
-        candidates = []  # list of triples (prev_hyp_idx, token, score)
-        for prev_hyp_idx, steps in enumerate(next_steps):
-            for step in steps:
-                token = step[0]
-                score = self.merge_score(self.hypotheses[prev_hyp_idx], step)
-                candidates.append((prev_hyp_idx, token, score))
-
-        candidates.sort(key=lambda x: x[-1], reverse=True)
-        live_nyp_num = self.beam_size - len(self.completed_hypotheses)
-        candidates = candidates[:live_nyp_num]
-
-        # collect new states for selected top candidates  
-        _split_state = dict()  # key => list of length live_nyp_num (number of selected top candidates)
-        _prev_hyp_idx = torch.tensor([x[0] for x in candidates])
-        if torch.cuda.is_available():
-            _prev_hyp_idx = _prev_hyp_idx.cuda()
-        for k, v in new_states.items():
-            split_dim = 1 if len(v.size()) >= 3 else 0
-            _split_state[k] = v.index_select(split_dim, _prev_hyp_idx).split(1, dim=split_dim)
-
-        # pack new hypotheses
-        new_hyps = []
-        for idx, (prev_hyp_idx, token, score) in enumerate(candidates):
-            state = dict()
-            for k, v in _split_state.items():
-                state[k] = _split_state[k][idx]
-            seq = self.hypotheses[prev_hyp_idx].seq + [token]
-            new_hyps.append(Hypothesis(state, seq, score))
-
-        # send new hypotheses to self.completed_hypotheses or self.hypotheses accordingly
-        self.hypotheses = []
-        for hyp in new_hyps:
-            if hyp.is_completed():
-                if self.steps >= self.min_time_step:
-                    self.completed_hypotheses.append(hyp)
-            else:
-                self.hypotheses.append(hyp)
-        self.steps += 1
-        # self.print_everything()
-
     def completed(self):
         if len(self.completed_hypotheses) < self.beam_size and self.steps < self.max_time_step:
             return False
@@ -133,76 +82,245 @@ class Beam(object):
             print(x.seq)
 
 
-def search_by_batch(model, beams, mem_dict):
+###########
+##rewrite##
+###########
+def token_flags(token):
+    # (never allowed, not allowed right after the first token)
+    invalid = token == UNK or (not token.endswith('_') and (':' in token or '/' in token or ',' in token))
+    return invalid, _is_attr_form(token)
+
+
+@lru_cache(maxsize=8)
+def _vocab_flags(vocab):
+    flags = [token_flags(vocab.idx2token(idx)) for idx in range(vocab.size)]
+    invalid, attr = zip(*flags)
+    return torch.tensor(invalid, dtype=torch.bool), torch.tensor(attr, dtype=torch.bool)
+
+
+class TokenTable(object):
+    """token ids of the extended vocabulary (shared vocab + per-sentence copy vocab) <=> strings,
+    and the per-token masks used to score candidates"""
+
+    def __init__(self, vocab, local_vocabs, device):
+        self.vocab = vocab
+        self.local_vocabs = local_vocabs
+        self.end_idx = vocab.token2idx(END)
+        invalid, attr = _vocab_flags(vocab)
+        self.invalid, self.attr = invalid.to(device), attr.to(device)
+
+        # ids beyond the shared vocab that a sentence does not own are never valid
+        ext_size = 1 + max([max(x) - vocab.size for x in local_vocabs if x] + [0])
+        local_invalid = torch.ones((len(local_vocabs), ext_size), dtype=torch.bool)
+        local_attr = torch.zeros((len(local_vocabs), ext_size), dtype=torch.bool)
+        for bidx, local_vocab in enumerate(local_vocabs):
+            for idx, token in local_vocab.items():
+                local_invalid[bidx, idx - vocab.size], local_attr[bidx, idx - vocab.size] = token_flags(token)
+        self.local_invalid, self.local_attr = local_invalid.to(device), local_attr.to(device)
+
+    def _lookup(self, shared, local, sent, token):
+        size = self.vocab.size
+        shared = shared[token.clamp(max=size - 1)]
+        local = local[sent.unsqueeze(1).expand_as(token), (token - size).clamp(min=0, max=local.size(1) - 1)]
+        return torch.where(token.lt(size), shared, local)
+
+    def is_invalid(self, sent, token, first_step):
+        # sent: bsz, token: bsz x k
+        invalid = self._lookup(self.invalid, self.local_invalid, sent, token)
+        # ids beyond every local vocab (the copy distribution is sized by the source length)
+        invalid = invalid | token.ge(self.vocab.size + self.local_invalid.size(1))
+        if first_step:
+            invalid = invalid | self._lookup(self.attr, self.local_attr, sent, token)
+        return invalid
+
+    def token2idx(self, token):
+        return self.vocab.token2idx(token)
+
+    def idx2token(self, token, sent):
+        res = []
+        for idx, bidx in zip(token, sent):
+            local_vocab = self.local_vocabs[bidx]
+            res.append(local_vocab[idx] if idx in local_vocab else self.vocab.idx2token(idx))
+        return res
+
+
+def _split_dim(v):
+    return 1 if len(v.size()) >= 3 else 0
+
+
+def _select(v, index):
+    if torch.is_tensor(v):
+        return v.index_select(_split_dim(v), index)
+    # states shared by the whole batch (e.g. DecoderCache) reorder themselves
+    return v.index_select(index)
+
+
+class History(object):
+    """
+    per-step records of the flat batch, stored once per step together with back-pointers
+    (the row of the previous step each row was expanded from), so hypotheses never copy them
+    """
+
+    def __init__(self):
+        self.records = []
+        self.parents = []
+
+    def append(self, records, parents):
+        self.records.append(records)
+        self.parents.append(parents)
+        return len(self.records) - 1
+
+    def trace(self, name, step, row):
+        res = []
+        for t in range(step, -1, -1):
+            v = self.records[t][name]
+            res.append(v.narrow(_split_dim(v), row, 1))
+            if self.parents[t] is not None:
+                row = self.parents[t][row]
+        return res[::-1]
+
+
+def search_by_batch(model, beams, mem_dict, alpha=None, prune_margin=None):
     '''
     beams, list of Beam, initial beams
     mem_dict, dict, those info. that will not change as decoding goes
         for each item in mem_dict, it must be a list of length len(beams) or a tensor with size(1) == len(beams)
+    alpha, prune_margin: early exit under the length-normalized score of Beam.get_k_best(k, alpha)
+        a beam stops as soon as none of its live hypotheses can beat its best completed one, assuming steps never
+        add to a score; besides, live hypotheses that would be worse than the best completed one by more than
+        prune_margin if they ended now are dropped (prune_margin=inf only stops, None disables both)
     '''
+    beam_size = beams[0].beam_size
+    max_time_step = beams[0].max_time_step
+    device = next(v for v in mem_dict.values() if torch.is_tensor(v)).device
+    ###########
+    ##rewrite##
+    ###########
+    table = TokenTable(model.vocabs['predictable_concept'], mem_dict['local_idx2token'], device)
 
-    def ready_to_submit(hypotheses):
+    def to_hypotheses(state_dict, step, index, seq, score, sent):
         '''
-        prepare state_dict and next token,
-        output them as one batch
+        pack rows of the flat batch into Hypothesis objects
+        state_dict and the records of step are indexed by index, seq/score/sent are already aligned with the rows
         '''
-        inp = model.prepare_incremental_input([hyp.seq[-1:] for hyp in hypotheses])
-        concat_hyps = dict()
-        for hyp in hypotheses:
+        _split_state = {k: _select(v, index).split(1, dim=_split_dim(v))
+                        for k, v in state_dict.items() if torch.is_tensor(v)}
+        hyps = []
+        for idx, (x, s, bidx, row) in enumerate(zip(seq.tolist(), score.tolist(), sent.tolist(), index.tolist())):
+            state = {k: v[idx] for k, v in _split_state.items()}
+            hyps.append(Hypothesis(state, table.idx2token(x, [bidx] * len(x)), s, (history, step, row)))
+        return hyps
+
+    # flatten the initial hypotheses
+    sent, seq, scores, init_states = [], [], [], dict()
+    for idx, beam in enumerate(beams):
+        if beam.completed():
+            continue
+        for hyp in beam.hypotheses:
+            sent.append(idx)
+            seq.append([table.token2idx(x) for x in hyp.seq])
+            scores.append(hyp.score)
             for k, v in hyp.state_dict.items():
-                concat_hyps[k] = concat_hyps.get(k, []) + [v]
-        for k, v in concat_hyps.items():
-            if len(v[0].size()) >= 3:
-                concat_hyps[k] = torch.cat(v, 1)
-            else:
-                concat_hyps[k] = torch.cat(v, 0)
-        return concat_hyps, inp
-
-    while True:
-        # collect incomplete beams and put all hypotheses together
-        hypotheses = []
-        indices = []  #
-        offset = -1  # the position of last token
-        for idx, beam in enumerate(beams):
-            if not beam.completed():
-                for hyp in beam.hypotheses:
-                    hypotheses.append(hyp)
-                    indices.append(idx)
-                    offset = len(hyp.seq) - 1
-        if not hypotheses:
-            break
-
-        state_dict, inp = ready_to_submit(hypotheses)
-
-        # collect mem_dict
-        cur_mem_dict = dict()
-        indices = torch.tensor(indices)
-        if torch.cuda.is_available():
-            indices = indices.cuda()
-        for k, v in mem_dict.items():
-            if isinstance(v, list):
-                cur_mem_dict[k] = [v[i] for i in indices]
-            else:
-                cur_mem_dict[k] = v.index_select(1, indices)
+                init_states[k] = init_states.get(k, []) + [v]
+        beam.hypotheses = []
+    state_dict = {k: torch.cat(v, _split_dim(v[0])) if torch.is_tensor(v[0]) else v[0]
+                  for k, v in init_states.items()}
+    sent = torch.tensor(sent, dtype=torch.long, device=device)
+    seq = torch.tensor(seq, dtype=torch.long, device=device)
+    scores = torch.tensor(scores, dtype=torch.double, device=device)
+    num_completed = torch.tensor([len(beam.completed_hypotheses) for beam in beams], device=device)
+    if prune_margin is not None:
+        best_completed = torch.tensor([max([x.score / ((1 + len(x.seq)) ** alpha) for x in beam.completed_hypotheses],
+                                           default=float('-inf')) for beam in beams],
+                                      dtype=torch.double, device=device)
+    history, parents = History(), None
+    mem_sent = None  # the rows cur_mem_dict is laid out for
+
+    while sent.numel() > 0:
+        offset = seq.size(1) - 1  # the position of last token
+        sent_list = sent.tolist()
+        inp = model.prepare_incremental_input([[x] for x in table.idx2token(seq[:, -1].tolist(), sent_list)])
+
+        # collect mem_dict, the rows of a sentence share its memory, so the expanded memory is kept as long as
+        # every sentence keeps the same number of alive hypotheses, and compacted only when that changes
+        if mem_sent is None or mem_sent.size(0) != sent.size(0) or not torch.equal(mem_sent, sent):
+            cur_mem_dict = dict()
+            for k, v in mem_dict.items():
+                if isinstance(v, list):
+                    cur_mem_dict[k] = [v[i] for i in sent_list]
+                else:
+                    cur_mem_dict[k] = v.index_select(1, sent)
+            mem_sent = sent
 
         # run one decode step
         # state_dict: for each item in state_dict, it must have the shape of (seq_len x bsz x *) or (bsz x dim)
-        # next_steps: list (bsz) of list (#beam_size) of (token, score)
-        state_dict, results = model.decode_step(inp, state_dict, cur_mem_dict, offset, beams[0].beam_size)
-
-        # dispatch the outcome to each beam
-        _len_each_beam = [len(beam.hypotheses) for beam in beams if not beam.completed()]
-        _state_dict_each_beam = [dict() for _ in _len_each_beam]
-
-        for k, v in state_dict.items():
-            split_dim = 1 if len(v.size()) >= 3 else 0
-            for i, x in enumerate(v.split(_len_each_beam, dim=split_dim)):
-                _state_dict_each_beam[i][k] = x
-
-        _pos = 0
-        _idx = 0
-        for beam in beams:
-            if not beam.completed():
-                _len = len(beam.hypotheses)
-                beam.update(_state_dict_each_beam[_idx], results[_pos:_pos + _len])
-                _pos += _len
-                _idx += 1
+        # records: outputs of this step that are kept (once) for the final hypotheses, same shapes as above
+        # topk_scores, topk_token: bsz x #beam_size
+        state_dict, records, topk_scores, topk_token = model.decode_step(inp, state_dict, cur_mem_dict, offset,
+                                                                         beam_size)
+        step = history.append(records, parents)
+
+        # score all candidates, scores are accumulated in double precision
+        cand_scores = scores.unsqueeze(1) + topk_scores.double()
+        cand_scores.masked_fill_(table.is_invalid(sent, topk_token, offset == 0), float('-inf'))
+
+        # lay out the candidates of each sentence in one row, ordered by (prev_hyp_idx, rank)
+        active, row, counts = torch.unique_consecutive(sent, return_inverse=True, return_counts=True)
+        starts = counts.cumsum(0) - counts
+        rank = torch.arange(sent.size(0), device=device) - starts[row]
+        num_sents, max_hyps = active.size(0), counts.max().item()
+        padded = cand_scores.new_full((num_sents, max_hyps, beam_size), float('-inf'))
+        padded[row, rank] = cand_scores
+        # stable sort keeps the original order among ties (including the padding, which comes last)
+        sorted_scores, order = padded.view(num_sents, -1).sort(dim=1, descending=True, stable=True)
+
+        # collect the top (#beam_size-#completed_hypotheses) new candidates of each sentence
+        live_hyp_num = beam_size - num_completed[active]
+        keep = torch.arange(max_hyps * beam_size, device=device).unsqueeze(0) < live_hyp_num.unsqueeze(1)
+        sel_row, sel_pos = keep.nonzero(as_tuple=True)
+        order = order[sel_row, sel_pos]
+        prev_hyp_idx = starts[sel_row] + order // beam_size
+        token = topk_token[prev_hyp_idx, order % beam_size]
+        new_scores = sorted_scores[sel_row, sel_pos]
+        new_sent = active[sel_row]
+        new_seq = torch.cat([seq.index_select(0, prev_hyp_idx), token.unsqueeze(1)], 1)
+
+        # send new hypotheses to completed_hypotheses or keep them alive accordingly
+        is_end = token.eq(table.end_idx)
+        steps = beams[sent_list[0]].steps
+        if steps >= beams[sent_list[0]].min_time_step and is_end.any():
+            done = is_end.nonzero(as_tuple=True)[0]
+            for hyp, bidx in zip(to_hypotheses(state_dict, step, prev_hyp_idx[done], new_seq[done],
+                                               new_scores[done], new_sent[done]), new_sent[done].tolist()):
+                beams[bidx].completed_hypotheses.append(hyp)
+            num_completed.index_add_(0, new_sent[done], torch.ones_like(done))
+            if prune_margin is not None:
+                best_completed.scatter_reduce_(0, new_sent[done], new_scores[done] / (1 + new_seq.size(1)) ** alpha,
+                                               'amax')
+
+        # finalize the beams that are completed after this step
+        beam_done = torch.zeros_like(num_completed, dtype=torch.bool)
+        for bidx in active.tolist():
+            beams[bidx].steps += 1
+            beam_done[bidx] = beams[bidx].completed()
+        alive = is_end.logical_not()
+        if prune_margin is not None:
+            # the best a live hypothesis can reach is to lose nothing more and end at the longest length
+            bound = (new_scores / (2 + max_time_step) ** alpha).masked_fill(is_end, float('-inf'))
+            best_bound = torch.full_like(best_completed, float('-inf')).scatter_reduce_(0, new_sent, bound, 'amax')
+            beam_done |= best_bound.le(best_completed)
+            hopeless = (new_scores / (2 + new_seq.size(1)) ** alpha).lt(best_completed[new_sent] - prune_margin)
+            alive = alive & hopeless.logical_not()
+        finished = (alive & beam_done[new_sent]).nonzero(as_tuple=True)[0]
+        if finished.numel() > 0:
+            for hyp, bidx in zip(to_hypotheses(state_dict, step, prev_hyp_idx[finished], new_seq[finished],
+                                               new_scores[finished], new_sent[finished]),
+                                 new_sent[finished].tolist()):
+                beams[bidx].hypotheses.append(hyp)
+
+        # reorder the states of the surviving hypotheses
+        alive = (alive & beam_done[new_sent].logical_not()).nonzero(as_tuple=True)[0]
+        prev_hyp_idx = prev_hyp_idx[alive]
+        state_dict = {k: _select(v, prev_hyp_idx) for k, v in state_dict.items()}
+        parents = prev_hyp_idx.tolist()
+        seq, scores, sent = new_seq[alive], new_scores[alive], new_sent[alive]
@@ -0,0 +1,227 @@
+import torch, logging, time, json, threading, queue, os
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from amr_parser.data import batchify, make_datum
+from amr_parser.postprocess import PostProcessor
+from amr_parser.utils import move_to_device
+from amr_parser.work import build_model, load_ckpt_without_bert, parse_batch, quantize_model
+
+import argparse
+
+logger = logging.getLogger(__name__)
+
+"""
+ Long-running parse server.
+ The parser, vocabs and tokenizer stay resident; incoming (preprocessed) sentences are collected into
+ length-bucketed micro-batches under a latency deadline and parsed together.
+
+ POST /parse  {"token": [...], "lemma": [...], "upos": [...], "ner": [...]}
+          or  {"sentences": [{...}, {...}]}
+          =>  {"amr": "...", "concept": [...], "score": float} (or a list of them)
+ GET /health
+"""
+
+
+def parse_config():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--load_path', type=str, default='amr_ckpt/epoch535_batch154999')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8990)
+    parser.add_argument('--unix_socket', type=str, default=None, help='serve on a unix socket instead of host:port')
+    parser.add_argument('--batch_tokens', type=int, default=4444, help='token budget of one micro-batch')
+    parser.add_argument('--max_wait', type=float, default=0.05, help='seconds a sentence may wait for a batch')
+    parser.add_argument('--timeout', type=float, default=120., help='seconds a request may wait for its result')
+    parser.add_argument('--beam_size', type=int, default=8)
+    parser.add_argument('--alpha', type=float, default=0.6)
+    parser.add_argument('--max_time_step', type=int, default=100)
+    parser.add_argument('--prune_margin', type=float, default=None,
+                        help='early exit of hopeless beams and hypotheses, see work.py')
+    parser.add_argument('--bf16', action='store_true', help='decode under bf16 autocast')
+    parser.add_argument('--quantize', action='store_true', help='dynamic int8 quantization, serves on CPU')
+
+    return parser.parse_args()
+
+
+class MicroBatcher(object):
+    """Collects sentences from many requests and parses them in length-bucketed micro-batches.
+
+    The batching thread waits for the first pending sentence, keeps collecting until max_wait seconds have
+    passed or batch_tokens tokens are pending, sorts what it got by length and parses it in batches of at most
+    batch_tokens tokens. The model is only touched by this thread.
+    """
+
+    def __init__(self, model, vocabs, lexical_mapping, batch_tokens, max_wait,
+                 beam_size=8, alpha=0.6, max_time_step=100, dtype=None,
+                 prune_margin=None):
+        self.model = model
+        self.vocabs = vocabs
+        self.lexical_mapping = lexical_mapping
+        self.pp = PostProcessor(vocabs['rel'])
+        self.batch_tokens = batch_tokens
+        self.max_wait = max_wait
+        self.beam_size = beam_size
+        self.alpha = alpha
+        self.max_time_step = max_time_step
+        self.dtype = dtype
+        self.prune_margin = prune_margin
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, sentence):
+        """sentence: dict with token, lemma, upos (and optionally xpos, ner), returns a Future of the result"""
+        future = Future()
+        token = sentence['token']
+        if len(token) == 0:
+            raise ValueError('empty sentence')
+        datum = make_datum(self.vocabs, self.lexical_mapping, token, sentence['lemma'], sentence['upos'],
+                           sentence.get('xpos', sentence['upos']), sentence.get('ner', ['O'] * len(token)))
+        if len(datum.get('bert_token', ())) > 512:
+            raise ValueError('sentence is too long for the bert encoder')
+        self._queue.put((datum, future))
+        return future
+
+    def _collect(self):
+        pending = [self._queue.get()]
+        num_tokens = len(pending[0][0]['tok'])
+        deadline = time.time() + self.max_wait
+        while num_tokens < self.batch_tokens:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            pending.append(item)
+            num_tokens += len(item[0]['tok'])
+        return pending
+
+    def _buckets(self, pending):
+        pending.sort(key=lambda x: len(x[0]['tok']))
+        batch, num_tokens = [], 0
+        for item in pending:
+            batch.append(item)
+            num_tokens += len(item[0]['tok'])
+            if num_tokens >= self.batch_tokens:
+                yield batch
+                batch, num_tokens = [], 0
+        if batch:
+            yield batch
+
+    def _run(self):
+        while True:
+            for batch in self._buckets(self._collect()):
+                try:
+                    data = move_to_device(batchify([x[0] for x in batch], self.vocabs), self.model.device)
+                    res = parse_batch(self.model, data, self.beam_size, self.alpha, self.max_time_step,
+                                      self.dtype, self.prune_margin)
+                    for (_, future), concept, relation, score in zip(batch, res['concept'], res['relation'],
+                                                                       res['score']):
+                        future.set_result({'amr': self.pp.postprocess(concept, relation),
+                                           'concept': concept,
+                                           'score': score})
+                except Exception as e:
+                    logger.exception('failed to parse a batch of %d sentences' % len(batch))
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+
+
+class ParseRequestHandler(BaseHTTPRequestHandler):
+    batcher = None
+    timeout_per_request = None
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/parse':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            sentences = request['sentences'] if 'sentences' in request else [request]
+            futures = [self.batcher.submit(x) for x in sentences]
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': repr(e)})
+            return
+        try:
+            results = [x.result(timeout=self.timeout_per_request) for x in futures]
+        except Exception as e:
+            self._reply(500, {'error': repr(e)})
+            return
+        self._reply(200, results if 'sentences' in request else results[0])
+
+    def address_string(self):
+        # client_address is empty on unix sockets
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def log_message(self, format, *args):
+        logger.info('%s %s' % (self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = self.server_address, 0
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    if torch.cuda.is_available():
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+
+    ckpt = torch.load(args.load_path, map_location='cpu')
+    model_args = ckpt['args']
+    # checkpoints written by work.py --save_quantized
+    quantized = ckpt.get('quantized', False)
+    if args.quantize or quantized:
+        device = torch.device('cpu')
+    model, vocabs, lexical_mapping = build_model(model_args, device)
+    if quantized:
+        quantize_model(model, inplace=True)
+        model.load_state_dict(ckpt['model'])
+    else:
+        load_ckpt_without_bert(model, args.load_path, device)
+        if args.quantize:
+            model = quantize_model(model, inplace=True)
+    del ckpt
+    model = model.to(device)
+    model.eval()
+
+    ParseRequestHandler.batcher = MicroBatcher(model, vocabs, lexical_mapping, args.batch_tokens, args.max_wait,
+                                               args.beam_size, args.alpha, args.max_time_step,
+                                               torch.bfloat16 if args.bf16 else None, args.prune_margin)
+    ParseRequestHandler.timeout_per_request = args.timeout
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, ParseRequestHandler)
+        logger.info('serving on %s' % args.unix_socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), ParseRequestHandler)
+        logger.info('serving on %s:%d' % (args.host, args.port))
+    server.serve_forever()
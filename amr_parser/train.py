@@ -1,17 +1,19 @@
 import torch, logging, time
+import numpy as np
 import torch.distributed as dist
 import torch.multiprocessing as mp
 
-import argparse, os, random
-from amr_parser.data import Vocab, DataLoader, DUM, END, CLS, NIL
+import argparse, os, random, json
+from concurrent.futures import ThreadPoolExecutor
+from amr_parser.data import Vocab, DataLoader, DUM, END, CLS, NIL, load_corpus
 from amr_parser.parser import Parser
 from amr_parser.work import show_progress
 from amr_parser.extract import LexicalMap
 from amr_parser.adam import AdamWeightDecayOptimizer
 from amr_parser.utils import move_to_device
-from amr_parser.bert_utils import BertEncoderTokenizer, BertEncoder
+from amr_parser.bert_utils import BertEncoderTokenizer, BertEncoder, load_bert_features
 from amr_parser.postprocess import PostProcessor
-from amr_parser.work import parse_data
+from amr_parser.work import parse_data, smatch_score
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -68,9 +70,15 @@ def parse_config():
     parser.add_argument('--train_batch_size', type=int)
     parser.add_argument('--batches_per_update', type=int)
     parser.add_argument('--dev_batch_size', type=int)
+    parser.add_argument('--cache_data', action='store_true', help='compile the data once and load it from <data>.cache')
+    parser.add_argument('--bert_features', action='store_true',
+                        help='encode the data with the frozen bert once, into <data>.bert, instead of every batch')
+    parser.add_argument('--data_workers', type=int, default=1, help='processes building training batches per rank')
+    parser.add_argument('--prefetch', type=int, default=10, help='batches built ahead per rank')
     parser.add_argument('--lr_scale', type=float)
     parser.add_argument('--warmup_steps', type=int)
     parser.add_argument('--resume_ckpt', type=str, default=None)
+    parser.add_argument('--keep_best', type=int, default=5, help='checkpoints kept by dev smatch, besides the latest')
     parser.add_argument('--ckpt', type=str)
     parser.add_argument('--print_every', type=int)
     parser.add_argument('--eval_every', type=int)
@@ -80,6 +88,9 @@ def parse_config():
     parser.add_argument('--MASTER_ADDR', type=str, default="localhost")
     parser.add_argument('--MASTER_PORT', type=str, default="8991")
     parser.add_argument('--start_rank', type=int, default=0)
+    parser.add_argument('--backend', type=str, default='nccl', help='nccl, or gloo for cpu processes')
+    parser.add_argument('--bucket_mb', type=float, default=25.,
+                        help='all-reduce gradients in buckets of this size during backward, 0 for one per parameter')
 
     return parser.parse_args()
 
@@ -92,6 +103,79 @@ def average_gradients(model):
             param.grad.data /= size
 
 
+class GradientReducer(object):
+    """
+    Averages the gradients over ranks like average_gradients, but in flat buckets of about bucket_mb megabytes
+    that are all-reduced asynchronously as soon as backward has produced all their gradients.
+    Buckets are launched strictly in order so all ranks issue the same sequence of collectives.
+    """
+
+    def __init__(self, model, bucket_mb=25.):
+        # backward produces gradients roughly in the reverse order of the parameters
+        params = [p for p in model.parameters() if p.requires_grad][::-1]
+        self.buckets, self.bucket_of = [], dict()
+        bucket, bucket_size = [], 0
+        for p in params:
+            if bucket and (bucket_size + p.numel() * p.element_size() > bucket_mb * 2 ** 20 or
+                           p.dtype != bucket[0].dtype or p.device != bucket[0].device):
+                self.buckets.append(bucket)
+                bucket, bucket_size = [], 0
+            bucket.append(p)
+            bucket_size += p.numel() * p.element_size()
+        if bucket:
+            self.buckets.append(bucket)
+        self._accumulators = []
+        for i, bucket in enumerate(self.buckets):
+            for p in bucket:
+                # the AccumulateGrad node of p runs once p.grad is complete for this backward
+                accumulator = p.expand_as(p).grad_fn.next_functions[0][0]
+                accumulator.register_hook(self._make_hook(i))
+                self._accumulators.append(accumulator)
+        self.sync = False
+        self._reset()
+
+    def _reset(self):
+        self._pending = [len(bucket) for bucket in self.buckets]
+        self._works = []
+
+    def _make_hook(self, i):
+        def hook(*unused):
+            if self.sync:
+                self._pending[i] -= 1
+                self._launch_ready()
+
+        return hook
+
+    def _launch(self, i):
+        # gradients a rank did not produce count as zeros
+        flat = torch.cat([(p.grad if p.grad is not None else torch.zeros_like(p)).reshape(-1)
+                          for p in self.buckets[i]])
+        self._works.append((flat, dist.all_reduce(flat, op=dist.ReduceOp.SUM, async_op=True)))
+
+    def _launch_ready(self):
+        while len(self._works) < len(self.buckets) and self._pending[len(self._works)] == 0:
+            self._launch(len(self._works))
+
+    def set_sync(self, sync):
+        """whether the next backward completes an update, only then gradients are reduced"""
+        self.sync = sync
+
+    def wait(self):
+        """finishes the reduction of the last backward (after set_sync(True)) and writes the averaged gradients"""
+        size = float(dist.get_world_size())
+        while len(self._works) < len(self.buckets):
+            self._launch(len(self._works))
+        for bucket, (flat, work) in zip(self.buckets, self._works):
+            work.wait()
+            flat /= size
+            offset = 0
+            for p in bucket:
+                if p.grad is not None:
+                    p.grad.copy_(flat[offset:offset + p.numel()].view_as(p.grad))
+                offset += p.numel()
+        self._reset()
+
+
 def update_lr(optimizer, lr_scale, embed_size, steps, warmup_steps):
     lr = lr_scale * embed_size ** -0.5 * min(steps ** -0.5, steps * (warmup_steps ** -1.5))
     for param_group in optimizer.param_groups:
@@ -99,11 +183,130 @@ def update_lr(optimizer, lr_scale, embed_size, steps, warmup_steps):
     return lr
 
 
-def data_proc(data, queue):
+def share_batch(batch):
+    # tensors are passed through the queue in shared memory instead of being pickled
+    return {k: torch.from_numpy(v) if isinstance(v, np.ndarray) else v for k, v in batch.items()}
+
+
+def data_proc(data, queue, seed, rank=0, world_size=1, worker=0, num_workers=1, start=(0, 0)):
+    """
+    Builds the batches of the worker-th of num_workers slices of this rank's shard, epoch after epoch.
+    All processes plan an epoch with the same rng (seed + epoch), so the shards of the ranks are disjoint.
+    Each batch is built with its own seed, so training can resume from start, an (epoch, batch) position.
+    """
+    epoch, step = start
     while True:
-        for x in data:
-            queue.put(x)
+        plan = data.batch_plan(random.Random(seed + epoch))[rank::world_size]
+        for k in range(worker, len(plan), num_workers):
+            if k < step:
+                continue
+            random.seed('%d %d %d %d' % (seed, rank, epoch, k))
+            queue.put(share_batch(data.make_batch(plan[k])))
         queue.put('EPOCHDONE')
+        epoch, step = epoch + 1, 0
+
+
+def resume_position(data, seed, rank, world_size, consumed):
+    """the (epoch, batch) position of data_proc after this rank has consumed that many batches, the shards of the
+    ranks can differ in length by one, so each rank walks through its own epochs"""
+    epoch = 0
+    while True:
+        num_batches = len(data.batch_plan(random.Random(seed + epoch))[rank::world_size])
+        if consumed < num_batches:
+            return epoch, consumed
+        consumed -= num_batches
+        epoch += 1
+
+
+def prefetch_batches(queues, step=0):
+    """
+    batches of the data_proc workers in the planned order, and 'EPOCHDONE' after each epoch;
+    step: the position the workers start the first epoch at
+    """
+    # the first epoch starts at the worker holding batch step
+    active = queues[step % len(queues):] + queues[:step % len(queues)]
+    while True:
+        # worker w holds the batches w, w + n, ... of an epoch, so it never runs out before a later worker
+        while active:
+            for queue in list(active):
+                batch = queue.get()
+                if isinstance(batch, str):
+                    active.remove(queue)
+                else:
+                    yield batch
+        yield 'EPOCHDONE'
+        active = list(queues)
+
+
+def cpu_copy(x):
+    if torch.is_tensor(x):
+        return x.detach().to('cpu', copy=True)
+    if isinstance(x, dict):
+        return {k: cpu_copy(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(cpu_copy(v) for v in x)
+    return x
+
+
+class CheckpointWriter(object):
+    """
+    Scores the dev output and writes checkpoints in a background thread, one at a time.
+    Only the keep_best checkpoints with the highest dev smatch (unscored ones rank below, newest first) and the
+    latest one are kept; the scores of the checkpoints in ckpt_dir are tracked in ckpt_dir/checkpoints.json.
+    """
+
+    def __init__(self, ckpt_dir, keep_best=5):
+        self.manifest = os.path.join(ckpt_dir, 'checkpoints.json')
+        self.keep_best = keep_best
+        self.checkpoints = []
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as f:
+                self.checkpoints = json.load(f)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._job = None
+
+    def save(self, state, path, dev_out=None, dev_data=None):
+        # the snapshot is taken now, training goes on while it is written
+        state = cpu_copy(state)
+        self.wait()
+        self._job = self._executor.submit(self._save, state, path, dev_out, dev_data)
+
+    def wait(self):
+        if self._job is not None:
+            self._job.result()
+            self._job = None
+
+    def _save(self, state, path, dev_out, dev_data):
+        # the checkpoint is written before it is scored, a failed scoring never loses it
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        score = None
+        if dev_out is not None:
+            try:
+                score = smatch_score(dev_out, dev_data)
+                logger.info('%s dev smatch %.4f' % (path, score))
+            except ImportError:
+                logger.warning('fast_smatch is not built, checkpoints are kept by recency only')
+            except Exception:
+                logger.exception('failed to score %s, it is kept by recency only' % dev_out)
+        # a path saved again (e.g. after resuming from an older checkpoint) only keeps its new record
+        self.checkpoints = [x for x in self.checkpoints if x['path'] != path]
+        self.checkpoints.append({'path': path, 'smatch': score})
+        self._prune()
+
+    def _prune(self):
+        # best scored first, then the unscored ones from the newest
+        scored = sorted(enumerate(self.checkpoints[:-1]),
+                        key=lambda x: (x[1]['smatch'] is not None, x[1]['smatch'] or 0., x[0]), reverse=True)
+        scored = [x for _, x in scored]
+        keep = scored[:self.keep_best] + self.checkpoints[-1:]
+        for x in scored[self.keep_best:]:
+            if os.path.exists(x['path']):
+                os.remove(x['path'])
+        self.checkpoints = [x for x in self.checkpoints if x in keep]
+        with open(self.manifest + '.tmp', 'w') as f:
+            json.dump(self.checkpoints, f, indent=1)
+        os.replace(self.manifest + '.tmp', self.manifest)
 
 
 def load_vocabs(args):
@@ -177,7 +380,14 @@ def main(local_rank, args):
         random.seed(19940117 + dist.get_rank())
     if torch.cuda.is_available():
         model = model.cuda(local_rank)
-    dev_data = DataLoader(vocabs, lexical_mapping, args.dev_data, args.dev_batch_size, for_train=False)
+    if args.cache_data and args.world_size > 1:
+        # rank 0 compiles the corpora, the others wait for them
+        if dist.get_rank() == 0:
+            for filename in (args.dev_data, args.train_data):
+                load_corpus(vocabs, lexical_mapping, filename, filename + '.cache')
+        dist.barrier()
+    dev_data = DataLoader(vocabs, lexical_mapping, args.dev_data, args.dev_batch_size, for_train=False,
+                          cache=args.cache_data)
     pp = PostProcessor(vocabs['rel'])
 
     weight_decay_params = []
@@ -193,28 +403,73 @@ def main(local_rank, args):
 
     used_batches = 0
     batches_acm = 0
+    epoch, epoch_step = 0, 0
+    train_state = None
     if args.resume_ckpt:
-        ckpt = torch.load(args.resume_ckpt)
+        ckpt = torch.load(args.resume_ckpt, map_location='cpu')
+        # checkpoints leave out the frozen bert encoder
+        for k, v in model.state_dict().items():
+            if k.startswith('bert_encoder.') and k not in ckpt['model']:
+                ckpt['model'][k] = v
         model.load_state_dict(ckpt['model'])
         optimizer.load_state_dict(ckpt['optimizer'])
         batches_acm = ckpt['batches_acm']
+        train_state = ckpt.get('train_state', None)
         del ckpt
+    if train_state is not None:
+        if args.world_size == 1 or dist.get_rank() == 0:
+            random.setstate(train_state['random'])
+            torch.set_rng_state(train_state['torch'])
+            if torch.cuda.is_available() and train_state['cuda'] is not None:
+                torch.cuda.set_rng_state(train_state['cuda'])
+        else:
+            # only the rng of rank 0 is saved
+            random.seed(19940117 + dist.get_rank() + batches_acm)
+            torch.manual_seed(19940117 + dist.get_rank() + batches_acm)
 
-    train_data = DataLoader(vocabs, lexical_mapping, args.train_data, args.train_batch_size, for_train=True)
+    train_data = DataLoader(vocabs, lexical_mapping, args.train_data, args.train_batch_size, for_train=True,
+                            cache=args.cache_data)
     train_data.set_unk_rate(args.unk_rate)
-    queue = mp.Queue(10)
-    train_data_generator = mp.Process(target=data_proc, args=(train_data, queue))
-
-    train_data_generator.start()
+    if args.bert_features:
+        for data, filename in ((train_data, args.train_data), (dev_data, args.dev_data)):
+            if args.world_size > 1:
+                # rank 0 computes the features, the others wait for them
+                if dist.get_rank() == 0:
+                    load_bert_features(bert_encoder, data, filename + '.bert')
+                dist.barrier()
+            data.set_bert_features(load_bert_features(bert_encoder, data, filename + '.bert'))
+    if args.world_size > 1:
+        rank, world_size = dist.get_rank(), args.world_size
+    else:
+        rank, world_size = 0, 1
+    if train_state is not None and 'used_batches' in train_state:
+        # every rank has consumed the same number of batches, but the ranks cross epochs at different points
+        used_batches = train_state['used_batches']
+        epoch, epoch_step = resume_position(train_data, 19940117, rank, world_size, used_batches)
+    elif train_state is not None:
+        # checkpoints without the count, the position is that of rank 0
+        used_batches = batches_acm * args.batches_per_update
+        epoch, epoch_step = train_state['epoch'], train_state['epoch_step']
+    queues = [mp.Queue(max(1, args.prefetch // args.data_workers)) for _ in range(args.data_workers)]
+    for worker, queue in enumerate(queues):
+        train_data_generator = mp.Process(target=data_proc, args=(train_data, queue, 19940117, rank, world_size,
+                                                                  worker, args.data_workers, (epoch, epoch_step)))
+        train_data_generator.start()
+    train_batches = prefetch_batches(queues, epoch_step)
+    ckpt_writer = CheckpointWriter(args.ckpt, args.keep_best)
+    reducer = None
+    if args.world_size > 1 and args.bucket_mb > 0:
+        reducer = GradientReducer(model, args.bucket_mb)
     model.train()
-    epoch, loss_avg, concept_loss_avg, arc_loss_avg, rel_loss_avg = 0, 0, 0, 0, 0
+    loss_avg, concept_loss_avg, arc_loss_avg, rel_loss_avg = 0, 0, 0, 0
     logger.info("Start Training")
     while True:
-        batch = queue.get()
+        batch = next(train_batches)
         if isinstance(batch, str):
-            epoch += 1
+            epoch, epoch_step = epoch + 1, 0
             # logger.info(f'[{local_rank}] epoch:{epoch} done(batches:{batches_acm})')
         else:
+            epoch_step += 1
             batch = move_to_device(batch, model.device)
             concept_loss, arc_loss, rel_loss, graph_arc_loss = model(batch)
             loss = (concept_loss + arc_loss + rel_loss) / args.batches_per_update
@@ -226,13 +481,17 @@ def main(local_rank, args):
             concept_loss_avg = concept_loss_avg * 0.8 + 0.2 * concept_loss_value
             arc_loss_avg = arc_loss_avg * 0.8 + 0.2 * arc_loss_value
             rel_loss_avg = rel_loss_avg * 0.8 + 0.2 * rel_loss_value
+            if reducer is not None:
+                reducer.set_sync((used_batches + 1) % args.batches_per_update == -1 % args.batches_per_update)
             loss.backward()
             used_batches += 1
             if not (used_batches % args.batches_per_update == -1 % args.batches_per_update):
                 continue
 
             batches_acm += 1
-            if args.world_size > 1:
+            if reducer is not None:
+                reducer.wait()
+            elif args.world_size > 1:
                 average_gradients(model)
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
             lr = update_lr(optimizer, args.lr_scale, args.embed_dim, batches_acm, args.warmup_steps)
@@ -246,20 +505,29 @@ def main(local_rank, args):
                 if (batches_acm > 10000 or args.resume_ckpt is not None) and \
                         (batches_acm % args.eval_every == -1 % args.eval_every):
                     model.eval()
-                    parse_data(model, pp, dev_data, args.dev_data,
-                               '%s/epoch%d_batch%d_dev_out' % (args.ckpt, epoch, batches_acm), logger=logger)
-                    torch.save({'args': args,
-                                'model': model.state_dict(),
-                                'batches_acm': batches_acm,
-                                'optimizer': optimizer.state_dict()},
-                               '%s/epoch%d_batch%d' % (args.ckpt, epoch, batches_acm))
+                    dev_out = '%s/epoch%d_batch%d_dev_out' % (args.ckpt, epoch, batches_acm)
+                    parse_data(model, pp, dev_data, args.dev_data, dev_out, logger=logger)
+                    cuda_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
+                    ckpt_writer.save({'args': args,
+                                      'model': {k: v for k, v in model.state_dict().items()
+                                                if not k.startswith('bert_encoder.')},
+                                      'batches_acm': batches_acm,
+                                      'optimizer': optimizer.state_dict(),
+                                      'train_state': {'epoch': epoch,
+                                                      'epoch_step': epoch_step,
+                                                      'used_batches': used_batches,
+                                                      'random': random.getstate(),
+                                                      'torch': torch.get_rng_state(),
+                                                      'cuda': cuda_state}},
+                                     '%s/epoch%d_batch%d' % (args.ckpt, epoch, batches_acm),
+                                     dev_out, args.dev_data)
                     model.train()
 
 
-def init_processes(local_rank, args, backend='nccl'):
+def init_processes(local_rank, args):
     os.environ['MASTER_ADDR'] = args.MASTER_ADDR
     os.environ['MASTER_PORT'] = args.MASTER_PORT
-    dist.init_process_group(backend, rank=args.start_rank + local_rank, world_size=args.world_size)
+    dist.init_process_group(args.backend, rank=args.start_rank + local_rank, world_size=args.world_size)
     main(local_rank, args)
 
 
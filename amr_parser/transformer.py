@@ -62,10 +62,15 @@ class TransformerLayer(nn.Module):
     def forward(self, x, kv=None,
                 self_padding_mask=None, self_attn_mask=None,
                 external_memories=None, external_padding_mask=None,
-                need_weights=None):
+                need_weights=None, self_kv=None, external_kv=None):
         # x: seq_len x bsz x embed_dim
+        # self_kv: keys and values of self-attention that are already projected (e.g. from a DecoderCache)
+        # external_kv: keys and values of external_memories that are already projected
         residual = x
-        if kv is None:
+        if self_kv is not None:
+            x, self_attn = self.self_attn(query=x, key=None, value=None, key_padding_mask=self_padding_mask,
+                                          attn_mask=self_attn_mask, need_weights=need_weights, static_kv=self_kv)
+        elif kv is None:
             x, self_attn = self.self_attn(query=x, key=x, value=x, key_padding_mask=self_padding_mask,
                                           attn_mask=self_attn_mask, need_weights=need_weights)
         else:
@@ -78,7 +83,8 @@ class TransformerLayer(nn.Module):
         if self.with_external:
             residual = x
             x, external_attn = self.external_attn(query=x, key=external_memories, value=external_memories,
-                                                  key_padding_mask=external_padding_mask, need_weights=need_weights)
+                                                  key_padding_mask=external_padding_mask, need_weights=need_weights,
+                                                  static_kv=external_kv)
             x = F.dropout(x, p=self.dropout, training=self.training)
             x = self.external_layer_norm(residual + x)
         else:
@@ -108,6 +114,7 @@ class MultiheadAttention(nn.Module):
         self.in_proj_bias = Parameter(torch.Tensor(3 * embed_dim))
 
         self.out_proj = nn.Linear(embed_dim, embed_dim, bias=True)
+        self.in_proj = None
         self.weights_dropout = weights_dropout
         self.reset_parameters()
 
@@ -117,18 +124,25 @@ class MultiheadAttention(nn.Module):
         nn.init.constant_(self.in_proj_bias, 0.)
         nn.init.constant_(self.out_proj.bias, 0.)
 
-    def forward(self, query, key, value, key_padding_mask=None, attn_mask=None, need_weights=None):
+    def forward(self, query, key, value, key_padding_mask=None, attn_mask=None, need_weights=None, static_kv=None):
         """ Input shape: Time x Batch x Channel
             key_padding_mask: Time x batch
             attn_mask:  tgt_len x src_len
+            static_kv: (k, v) already projected by in_proj_kv, key and value are ignored
         """
-        qkv_same = query.data_ptr() == key.data_ptr() == value.data_ptr()
-        kv_same = key.data_ptr() == value.data_ptr()
-
         tgt_len, bsz, embed_dim = query.size()
-        assert key.size() == value.size()
 
-        if qkv_same:
+        if static_kv is None:
+            # identity rather than data_ptr, which traced and exported graphs cannot read
+            qkv_same = query is key is value
+            kv_same = key is value
+            assert key.size() == value.size()
+
+        if static_kv is not None:
+            # keys and values are projected already
+            q = self.in_proj_q(query)
+            k, v = static_kv
+        elif qkv_same:
             # self-attention
             q, k, v = self.in_proj_qkv(query)
         elif kv_same:
@@ -167,7 +181,8 @@ class MultiheadAttention(nn.Module):
             )
             attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
 
-        attn_weights = F.softmax(attn_weights, dim=-1)
+        # in fp32 under autocast, the weights are returned as arc probabilities and copy alignments
+        attn_weights = F.softmax(attn_weights.float(), dim=-1)
 
         if self.weights_dropout:
             attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
@@ -211,7 +226,31 @@ class MultiheadAttention(nn.Module):
     def in_proj_v(self, value):
         return self._in_proj(value, start=2 * self.embed_dim)
 
+    def unpack_in_proj(self):
+        """ replace in_proj_weight and in_proj_bias by nn.Linear modules for the qkv, q and kv projections,
+            so that module transforms such as dynamic quantization also apply to them
+        """
+        if self.in_proj is not None:
+            return self
+        in_proj = nn.ModuleDict()
+        for name, start, end in (('qkv', 0, None), ('q', 0, self.embed_dim), ('kv', self.embed_dim, None)):
+            weight = self.in_proj_weight[start:end, :]
+            linear = nn.Linear(weight.size(1), weight.size(0)).to(weight)
+            with torch.no_grad():
+                linear.weight.copy_(weight)
+                linear.bias.copy_(self.in_proj_bias[start:end])
+            in_proj[name] = linear
+        del self.in_proj_weight
+        del self.in_proj_bias
+        self.in_proj = in_proj
+        return self
+
     def _in_proj(self, input, start=0, end=None):
+        if self.in_proj is not None:
+            if start == 0:
+                return self.in_proj['qkv' if end is None else 'q'](input)
+            kv = self.in_proj['kv'](input)
+            return kv[..., start - self.embed_dim:None if end is None else end - self.embed_dim]
         weight = self.in_proj_weight
         bias = self.in_proj_bias
         weight = weight[start:end, :]
@@ -220,6 +259,69 @@ class MultiheadAttention(nn.Module):
         return F.linear(input, weight, bias)
 
 
+class DecoderCache(object):
+    """Decoding states that grow by one position per time step.
+
+    Each buffer is preallocated as length x capacity x * on first use, written in place at the step index and
+    reordered along the batch dimension when hypotheses are selected, so no step needs to re-concatenate the
+    history. The length doubles (up to max_time_step) whenever a step does not fit, so buffers stay within twice
+    the actual decoding length. Two buffers are kept per state and reordering ping-pongs between them.
+    """
+
+    def __init__(self, max_time_step, capacity, init_length=8):
+        self.max_time_step = max_time_step
+        self.capacity = capacity
+        self.init_length = init_length
+        self.bsz = None
+        self.length = 0
+        self._buffers = dict()
+
+    def _grow(self, bufs, length):
+        """bufs with room for length positions, the states written so far are kept"""
+        src = bufs[0]
+        size = (length,) + tuple(src.size()[1:])
+        new = [src.new_empty(size), src.new_empty(size)]
+        if self.length > 0:
+            new[0][:self.length, :self.bsz].copy_(src[:self.length, :self.bsz])
+        return new
+
+    def views(self, names, step, bsz, like):
+        """
+        the states of positions [0, step] of each of names (step + 1 x bsz x *), the newest position is to be
+        written in place by the caller (see DecodeStep), buffers are allocated with the dtype, device and
+        trailing size of like
+        """
+        res = []
+        for name in names:
+            if name not in self._buffers:
+                size = (min(self.max_time_step, max(self.init_length, step + 1)), self.capacity) \
+                       + tuple(like.size()[2:])
+                self._buffers[name] = [like.new_empty(size), like.new_empty(size)]
+            bufs = self._buffers[name]
+            if bufs[0].size(0) <= step:
+                self._buffers[name] = bufs = self._grow(bufs, max(step + 1, min(self.max_time_step,
+                                                                                2 * bufs[0].size(0))))
+            res.append(bufs[0][:step + 1, :bsz])
+        self.bsz = bsz
+        self.length = step + 1
+        return res
+
+    def read(self, name):
+        return self._buffers[name][0][:self.length, :self.bsz]
+
+    def __contains__(self, name):
+        return name in self._buffers
+
+    def index_select(self, index):
+        """keep (and reorder) the hypotheses in index, in place"""
+        for bufs in self._buffers.values():
+            src, dst = bufs
+            torch.index_select(src[:self.length, :self.bsz], 1, index, out=dst[:self.length, :index.size(0)])
+            bufs.reverse()
+        self.bsz = index.size(0)
+        return self
+
+
 def Embedding(num_embeddings, embedding_dim, padding_idx):
     m = nn.Embedding(num_embeddings, embedding_dim, padding_idx=padding_idx)
     nn.init.normal_(m.weight, std=0.02)
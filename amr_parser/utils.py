@@ -17,9 +17,12 @@ def exe_time(func):
 
 def move_to_device(maybe_tensor, device):
     if torch.is_tensor(maybe_tensor):
+        if maybe_tensor.is_floating_point():
+            # features, e.g. precomputed bert outputs
+            return maybe_tensor.to(device)
         return maybe_tensor.to(device, dtype=torch.long)
     elif isinstance(maybe_tensor, np.ndarray):
-        return torch.from_numpy(maybe_tensor).to(device, dtype=torch.long).contiguous()
+        return move_to_device(torch.from_numpy(maybe_tensor), device).contiguous()
     elif isinstance(maybe_tensor, dict):
         return {
             key: move_to_device(value, device)
@@ -1,14 +1,21 @@
-import torch, logging, time
+import torch, logging, time, copy, json
+import numpy as np
+from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 
 from amr_parser.data import Vocab, DataLoader, DUM, END, CLS, NIL
-from amr_parser.parser import Parser
+from amr_parser.parser import Parser, EnsembleParser
+from amr_parser.transformer import MultiheadAttention
 from amr_parser.postprocess import PostProcessor
-from amr_parser.extract import LexicalMap
+from amr_parser.extract import LexicalMap, AMRIO
 from amr_parser.utils import move_to_device
 from amr_parser.bert_utils import BertEncoderTokenizer, BertEncoder
 from transformers import ElectraConfig
 
 import argparse, os, re
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -28,8 +35,31 @@ def parse_config():
     parser.add_argument('--beam_size', type=int, default=8)
     parser.add_argument('--alpha', type=float, default=0.6)
     parser.add_argument('--max_time_step', type=int, default=100)
+    parser.add_argument('--prune_margin', type=float, default=None,
+                        help='stop a beam once no live hypothesis can beat its best completed one and drop hypotheses '
+                             'worse than it by more than this margin (length normalized by alpha), inf only stops')
     parser.add_argument('--output_suffix', type=str, default='eval_test')
+    parser.add_argument('--ensemble', action='store_true',
+                        help='decode with all the checkpoints in load_path at once, averaging their log-likelihoods, '
+                             'the output goes to <load_path>/ensemble<output_suffix>')
+    parser.add_argument('--nbest', type=int, default=None,
+                        help='also write the distinct top graphs (at most beam_size) of each sentence with their '
+                             'scores to <output>.nbest.jsonl')
     parser.add_argument('--device', type=int, default=0)
+    parser.add_argument('--pipeline', action='store_true', help='overlap postprocessing with decoding')
+    parser.add_argument('--sort_by_length', action='store_true',
+                        help='batch sentences of similar length, test_batch_size is then the padded source size')
+    parser.add_argument('--cache_data', action='store_true', help='compile the data once and load it from <data>.cache')
+    parser.add_argument('--bf16', action='store_true', help='decode under bf16 autocast')
+    parser.add_argument('--quantize', action='store_true',
+                        help='dynamic int8 quantization of the encoders and generators, decodes on CPU')
+    parser.add_argument('--save_quantized', action='store_true',
+                        help='with --quantize, save the quantized model as <checkpoint>.int8, it loads like a checkpoint')
+    parser.add_argument('--check_data', type=str, default=None,
+                        help='dev slice with gold graphs, with --bf16 or --quantize its smatch and speed are compared '
+                             'to fp32 before parsing')
+    parser.add_argument('--max_smatch_drop', type=float, default=0.005,
+                        help='largest smatch drop of --bf16 or --quantize on --check_data that is accepted')
 
     return parser.parse_args()
 
@@ -46,76 +76,196 @@ def show_progress(model, dev_data):
     return loss_acm
 
 
-def parse_batch(model, batch, beam_size, alpha, max_time_step):
+def trace_relation(hyp, num_concepts):
+    """arc probabilities and relation ids of the concepts of hyp, as num_concepts x num_concepts (dep x head)"""
+    arc = np.zeros((num_concepts, num_concepts), dtype=np.float32)
+    rel = np.zeros((num_concepts, num_concepts), dtype=np.int64)
+    if num_concepts > 1:
+        # step i predicts the arcs of concept i over the heads [<DUMMY>, concept_0, ..., concept_{i-1}]
+        arc_ll = [x.view(-1)[1:] for x in hyp.trace('arc_ll')[1:num_concepts]]
+        rel_ll = [x.view(-1)[1:] for x in hyp.trace('rel')[1:num_concepts]]
+        arc[1:, :-1] = pad_sequence(arc_ll, batch_first=True, padding_value=float('-inf')).exp().cpu().numpy()
+        rel[1:, :-1] = pad_sequence(rel_ll, batch_first=True).cpu().numpy()
+    return arc, rel
+
+
+def parse_batch(model, batch, beam_size, alpha, max_time_step, dtype=None, prune_margin=None, nbest=None):
+    """
+    nbest: also keep the top nbest hypotheses of each sentence as res['nbest'], lists of (concept, relation, score)
+        best first, the first one is the 1-best
+    """
     res = dict()
     concept_batch = []
     relation_batch = []
-    beams = model.work(batch, beam_size, max_time_step)
+    beams = model.work(batch, beam_size, max_time_step, dtype=dtype, alpha=alpha, prune_margin=prune_margin)
     score_batch = []
+    nbest_batch = []
     for beam in beams:
-        best_hyp = beam.get_k_best(1, alpha)[0]
-        predicted_concept = [token for token in best_hyp.seq[1:-1]]
-        predicted_rel = []
-        for i in range(len(predicted_concept)):
-            if i == 0:
-                continue
-            arc = best_hyp.state_dict['arc_ll%d' % i].squeeze_().exp_()[1:]  # head_len
-            rel = best_hyp.state_dict['rel_ll%d' % i].squeeze_().exp_()[1:, :]  # head_len x vocab
-            for head_id, (arc_prob, rel_prob) in enumerate(zip(arc.tolist(), rel.tolist())):
-                predicted_rel.append((i, head_id, arc_prob, rel_prob))
+        hyps = []
+        for hyp in beam.get_k_best(nbest or 1, alpha):
+            predicted_concept = [token for token in hyp.seq[1:-1]]
+            hyps.append((predicted_concept, trace_relation(hyp, len(predicted_concept)), hyp.score))
+        predicted_concept, relation, score = hyps[0]
         concept_batch.append(predicted_concept)
-        score_batch.append(best_hyp.score)
-        relation_batch.append(predicted_rel)
+        score_batch.append(score)
+        relation_batch.append(relation)
+        nbest_batch.append(hyps)
     res['concept'] = concept_batch
     res['score'] = score_batch
     res['relation'] = relation_batch
+    if nbest is not None:
+        res['nbest'] = nbest_batch
     return res
 
 
-def parse_data(model, pp, data, input_file, output_file, beam_size=8, alpha=0.6, max_time_step=100, logger=None):
+def distinct_graphs(pp, hyps):
+    """the graphs of hyps, a list of (concept, relation, score) best first, each on one line, hypotheses whose
+    triples are the same as those of a better one are dropped"""
+    graphs, seen = [], set()
+    for concept, relation, score in hyps:
+        triples = pp.triples(concept, relation)
+        key = frozenset(triples)
+        if key in seen:
+            continue
+        seen.add(key)
+        graphs.append({'score': score, 'concept': concept, 'amr': pp.to_string(triples, indent=None)})
+    return graphs
+
+
+def write_batch(fo, pp, res, fo_nbest=None):
+    """fo_nbest: one json line per sentence, {"nbest": distinct_graphs of res['nbest']}"""
+    for concept, relation, score in zip(res['concept'], res['relation'], res['score']):
+        fo.write('# ::conc ' + ' '.join(concept) + '\n')
+        fo.write('# ::score %.6f\n' % score)
+        fo.write(pp.postprocess(concept, relation) + '\n\n')
+    if fo_nbest is not None:
+        for hyps in res['nbest']:
+            fo_nbest.write(json.dumps({'nbest': distinct_graphs(pp, hyps)}) + '\n')
+    return len(res['concept'])
+
+
+def parse_in_order(model, data, beam_size=8, alpha=0.6, max_time_step=100, dtype=None, prune_margin=None,
+                   nbest=None):
+    """
+    parse_batch over data, batches that carry the original positions of their sentences ('index') are
+    put back in the original order, results are yielded as soon as they are next in line
+    """
+    pending, nxt = dict(), 0
+    for batch in data:
+        index = batch.get('index', None)
+        batch = move_to_device(batch, model.device)
+        res = parse_batch(model, batch, beam_size, alpha, max_time_step, dtype, prune_margin, nbest)
+        if index is None:
+            yield res
+            continue
+        keys = list(res.keys())
+        for i, *values in zip(index, *[res[k] for k in keys]):
+            pending[i] = values
+        ready = []
+        while nxt in pending:
+            ready.append(pending.pop(nxt))
+            nxt += 1
+        if ready:
+            yield {k: list(v) for k, v in zip(keys, zip(*ready))}
+
+
+def parse_data(model, pp, data, input_file, output_file, beam_size=8, alpha=0.6, max_time_step=100, logger=None,
+               pipeline=False, dtype=None, prune_margin=None, nbest=None):
+    """
+    pipeline: postprocess and write a batch in a background thread while the next batch is decoded
+    dtype: autocast dtype of decoding, see Parser.work
+    prune_margin: early exit of hopeless beams and hypotheses, see search_by_batch
+    nbest: also write the distinct graphs of the top nbest hypotheses to output_file.nbest.jsonl, see write_batch
+    """
     tot = 0
-    with open(output_file, 'w', encoding='utf-8') as fo:
-        for batch in data:
-            batch = move_to_device(batch, model.device)
-            res = parse_batch(model, batch, beam_size, alpha, max_time_step)
-            for concept, relation, score in zip(res['concept'], res['relation'], res['score']):
-                fo.write('# ::conc ' + ' '.join(concept) + '\n')
-                fo.write('# ::score %.6f\n' % score)
-                fo.write(pp.postprocess(concept, relation) + '\n\n')
-                tot += 1
+    with open(output_file, 'w', encoding='utf-8') as fo, \
+            (open(output_file + '.nbest.jsonl', 'w', encoding='utf-8') if nbest is not None else nullcontext()) \
+            as fo_nbest:
+        if not pipeline:
+            for res in parse_in_order(model, data, beam_size, alpha, max_time_step, dtype, prune_margin, nbest):
+                tot += write_batch(fo, pp, res, fo_nbest)
+        else:
+            # one worker keeps the output in order; waiting on the oldest job bounds the backlog
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                jobs = deque()
+                for res in parse_in_order(model, data, beam_size, alpha, max_time_step, dtype, prune_margin, nbest):
+                    jobs.append(executor.submit(write_batch, fo, pp, res, fo_nbest))
+                    if len(jobs) > 2:
+                        tot += jobs.popleft().result()
+                while jobs:
+                    tot += jobs.popleft().result()
     # match(output_file, input_file)
     if logger is None:
         print('write down %d amrs' % tot)
     else:
         logger.info(print('write down %d amrs' % tot))
+    return tot
+
+
+def smatch_score(pred_file, gold_file):
+    """smatch f-score of the graphs in pred_file against gold_file, needs the fast_smatch extension to be built"""
+    from fast_smatch._smatch import get_best_match, compute_f
+    match_num, test_num, gold_num = 0, 0, 0
+    for (_, pred), (_, gold) in zip(AMRIO.read(pred_file), AMRIO.read(gold_file)):
+        pred.rename_node('a')
+        gold.rename_node('b')
+        # duplicated triples would be matched more than once
+        pred_triples = [list(dict.fromkeys(x)) for x in pred.get_triples()]
+        gold_triples = [list(dict.fromkeys(x)) for x in gold.get_triples()]
+        _, best_match_num = get_best_match(*pred_triples, *gold_triples, 'a', 'b')
+        match_num += best_match_num
+        test_num += sum(len(x) for x in pred_triples)
+        gold_num += sum(len(x) for x in gold_triples)
+    return compute_f(match_num, test_num, gold_num)[2]
+
+
+def precision_regression(variants, pp, data, gold_file, output_file, beam_size=8, alpha=0.6, max_time_step=100):
+    """
+    parse data (a fixed dev slice with gold graphs in gold_file) with each of variants, a list of
+    (name, model, autocast dtype), returns {name: (smatch, sentences per second)}, outputs go to output_file.<name>
+    """
+    res = dict()
+    for name, model, dtype in variants:
+        start_time = time.time()
+        tot = parse_data(model, pp, data, gold_file, output_file + '.' + name, beam_size, alpha, max_time_step,
+                         dtype=dtype)
+        res[name] = (smatch_score(output_file + '.' + name, gold_file), tot / (time.time() - start_time))
+    return res
+
+
+def quantize_model(model, inplace=False):
+    """
+    dynamic int8 quantization of the Linear layers (attention projections included) of the bert encoder, the
+    sentence and graph transformers and the arc, concept and relation generators, the result runs on CPU only
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model = model.cpu()
+    for module in model.modules():
+        if isinstance(module, MultiheadAttention):
+            module.unpack_in_proj()
+    for module in (model.bert_encoder, model.snt_encoder, model.graph_encoder, model.decoder):
+        torch.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def save_quantized(model, model_args, path):
+    """the bert encoder is saved as well, it is quantized too"""
+    torch.save({'args': model_args, 'model': model.state_dict(), 'quantized': True}, path)
 
 
 def load_ckpt_without_bert(model, test_model, device):
-    ckpt = torch.load(test_model, map_location=device)['model']
+    """test_model: a checkpoint file or a checkpoint already loaded"""
+    ckpt = torch.load(test_model, map_location=device) if isinstance(test_model, str) else test_model
+    ckpt = ckpt['model']
     for k, v in model.state_dict().items():
         if k.startswith('bert_encoder'):
             ckpt[k] = v
     model.load_state_dict(ckpt)
 
 
-if __name__ == "__main__":
-    args = parse_config()
-    test_models = []
-    if torch.cuda.is_available():
-        device = torch.device('cuda')
-    else:
-        device = torch.device('cpu')
-
-    if os.path.isdir(args.load_path):
-        for file in os.listdir(args.load_path):
-            fname = os.path.join(args.load_path, file)
-            if os.path.isfile(fname):
-                test_models.append(fname)
-        model_args = torch.load(fname, map_location=device)['args']
-    else:
-        test_models.append(args.load_path)
-        model_args = torch.load(args.load_path, map_location=device)['args']
-
+def build_model(model_args, device, bert_encoder=None):
+    """bert_encoder: share this encoder instead of loading one (its weights are not in the checkpoints)"""
     vocabs = dict()
     vocabs['tok'] = Vocab(model_args.tok_vocab, 5, [CLS])
     vocabs['lem'] = Vocab(model_args.lem_vocab, 5, [CLS])
@@ -132,7 +282,8 @@ if __name__ == "__main__":
     lexical_mapping = LexicalMap()
 
     bert_tokenizer = BertEncoderTokenizer.from_pretrained(model_args.bert_path, do_lower_case=False)
-    bert_encoder = BertEncoder.from_pretrained(model_args.bert_path)
+    if bert_encoder is None:
+        bert_encoder = BertEncoder.from_pretrained(model_args.bert_path)
     vocabs['bert_tokenizer'] = bert_tokenizer
 
     model = Parser(
@@ -158,6 +309,34 @@ if __name__ == "__main__":
         bert_encoder=bert_encoder,
         device=device
     )
+    return model, vocabs, lexical_mapping
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    test_models = []
+    if torch.cuda.is_available():
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+
+    if os.path.isdir(args.load_path):
+        for file in os.listdir(args.load_path):
+            fname = os.path.join(args.load_path, file)
+            if os.path.isfile(fname):
+                test_models.append(fname)
+        ckpt = torch.load(fname, map_location='cpu')
+    else:
+        test_models.append(args.load_path)
+        ckpt = torch.load(args.load_path, map_location='cpu')
+    model_args = ckpt['args']
+    del ckpt
+    if args.quantize:
+        device = torch.device('cpu')
+
+    fp32_model, vocabs, lexical_mapping = build_model(model_args, device)
+    # the model of the checkpoints written by save_quantized (load_path can mix both), built on first use
+    int8_model = None
 
     # test_data = DataLoader(vocabs, lexical_mapping, args.test_data, args.test_batch_size, for_train=True)
     another_test_data = DataLoader(
@@ -165,28 +344,104 @@ if __name__ == "__main__":
         lexical_mapping,
         args.test_data,
         args.test_batch_size,
-        for_train=False
+        for_train=False,
+        sort_by_length=args.sort_by_length,
+        cache=args.cache_data
     )
-    for test_model in test_models:
-        print(test_model)
-        batch = int(re.search(r'batch([0-9])+', test_model)[0][5:])
-        epoch = int(re.search(r'epoch([0-9])+', test_model)[0][5:])
-
-        load_ckpt_without_bert(model, test_model, device)
-        model = model.to(device)
-        model.eval()
-        # loss = show_progress(model, test_data)
-        pp = PostProcessor(vocabs['rel'])
-        logger.info('start parsing')
+    if args.ensemble:
+        if args.quantize:
+            raise ValueError('--ensemble does not support quantized models')
+        parsers = []
+        for test_model in test_models:
+            ckpt = torch.load(test_model, map_location='cpu')
+            if ckpt.get('quantized', False):
+                logger.warning('%s is quantized, it is left out of the ensemble' % test_model)
+                continue
+            print(test_model)
+            # the checkpoints do not carry the bert weights, one encoder is shared by all the parsers
+            parser = fp32_model if not parsers else build_model(model_args, device, fp32_model.bert_encoder)[0]
+            load_ckpt_without_bert(parser, ckpt, device)
+            parsers.append(parser)
+            del ckpt
+        if not parsers:
+            raise ValueError('no checkpoint in %s can be ensembled' % args.load_path)
+        ensemble = EnsembleParser(parsers).to(device)
+        ensemble.eval()
+        logger.info('start parsing with an ensemble of %d checkpoints' % len(parsers))
         start_time = time.time()
         parse_data(
-            model, pp,
+            ensemble, PostProcessor(vocabs['rel']),
             another_test_data,
             args.test_data,
-            test_model + args.output_suffix,
+            os.path.join(args.load_path, 'ensemble' + args.output_suffix),
             args.beam_size,
             args.alpha,
-            args.max_time_step
+            args.max_time_step,
+            pipeline=args.pipeline,
+            dtype=torch.bfloat16 if args.bf16 else None,
+            prune_margin=args.prune_margin,
+            nbest=args.nbest
         )
         end_time = time.time()
         logger.info(f'done! time: {end_time - start_time}')
+    else:
+        for test_model in test_models:
+            print(test_model)
+            batch = int(re.search(r'batch([0-9])+', test_model)[0][5:])
+            epoch = int(re.search(r'epoch([0-9])+', test_model)[0][5:])
+
+            ckpt = torch.load(test_model, map_location='cpu')
+            # checkpoints written by save_quantized run on CPU
+            quantized = ckpt.get('quantized', False)
+            if quantized:
+                if int8_model is None:
+                    int8_model = quantize_model(fp32_model)
+                model = int8_model
+                model.load_state_dict(ckpt['model'])
+            else:
+                model = fp32_model
+                load_ckpt_without_bert(model, ckpt, device)
+                model = model.to(device)
+            del ckpt
+            model.eval()
+            # loss = show_progress(model, test_data)
+            pp = PostProcessor(vocabs['rel'])
+            dtype = torch.bfloat16 if args.bf16 else None
+            test_parser = model
+            if args.quantize and not quantized:
+                test_parser = quantize_model(model)
+                if args.save_quantized:
+                    save_quantized(test_parser, model_args, test_model + '.int8')
+            if args.check_data is not None and (args.bf16 or test_parser is not model):
+                check_data = DataLoader(vocabs, lexical_mapping, args.check_data, args.test_batch_size, for_train=False,
+                                        sort_by_length=args.sort_by_length, cache=args.cache_data)
+                reference = 'int8' if quantized else 'fp32'
+                name = '+'.join(x for x, on in (('int8', test_parser is not model or quantized), ('bf16', args.bf16))
+                                if on)
+                res = precision_regression([(reference, model, None), (name, test_parser, dtype)], pp, check_data,
+                                           args.check_data, test_model + args.output_suffix,
+                                           args.beam_size, args.alpha, args.max_time_step)
+                for x, (score, speed) in res.items():
+                    logger.info('%s smatch %.4f %.2f sentences/s' % (x, score, speed))
+                drop = res[reference][0] - res[name][0]
+                logger.info('%s vs %s: smatch %+.4f, %.2fx sentences/s' % (name, reference, -drop,
+                                                                          res[name][1] / res[reference][1]))
+                if drop > args.max_smatch_drop:
+                    raise RuntimeError('%s loses %.4f smatch on %s' % (name, drop, args.check_data))
+            logger.info('start parsing')
+            start_time = time.time()
+            parse_data(
+                test_parser, pp,
+                another_test_data,
+                args.test_data,
+                test_model + args.output_suffix,
+                args.beam_size,
+                args.alpha,
+                args.max_time_step,
+                pipeline=args.pipeline,
+                dtype=dtype,
+                prune_margin=args.prune_margin,
+                nbest=args.nbest
+            )
+            end_time = time.time()
+            logger.info(f'done! time: {end_time - start_time}')